@@ -2,17 +2,52 @@
 """
 cbr2cbz.py - converts CBR comic book files (RAR) to CBZ (as uncompressed zip)
 
-Requires system commands: unrar
+Requires system commands: unrar (or 7z/bsdtar) for RAR archives
 """
 
 import os
 import sys
 import re
 import shutil
+import stat
+import struct
 import argparse # argparse requires 3.2 and up
 # Subprocess for external unrar command
 import subprocess
 import zipfile
+import tarfile
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib
+import io
+import binascii
+import zlib
+import json
+import multiprocessing
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Optional - fcntl (not on Windows) is used for reflink copies
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Optional - Pillow is used for the in-process --shrink image backend
+try:
+    from PIL import Image, ImageChops
+except ImportError:
+    Image = None
+
+# Optional - NumPy speeds up --shrinkAutoGray page checks
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Kludgy global for the temp folder (used by all the functions in one way or other)
 # New - use /tmp (which is in RAM/Swap tmpfs) for speed and reduced SSD/drive wear
@@ -21,257 +56,2617 @@ cbr2cbztemp = os.path.abspath(
     os.path.expanduser(
     "/tmp/cbr2cbztemp-u{0}/p{1}".format(os.getuid(),os.getpid()))
     )
+# All the temp folders a conversion may put its workspace in, in order of
+# preference. main() sets one per existing --tempdir candidate
+cbr2cbztemproots = [cbr2cbztemp]
 
 # Default ImageMagick version
 imversion = 6
 
-def cbr2cbzclean(create=True,delete=False):
+# Image backend used by --shrink, one of imagebackends or "auto" (Pillow if
+# installed, otherwise ImageMagick). Overridden by --imbackend
+imbackend = "auto"
+
+# Buffer size used when streaming archive members straight into the
+# output zip (bounds memory use per member)
+streambufsize = 1024*1024
+
+# Streamed RAR members that arrive ahead of their turn in the output's sort
+# order are held in memory up to this size, larger ones go to the temp folder.
+# Together an archive's members held in memory stay under spoolmemory and
+# within the memorybudget, the rest go to the temp folder too
+spoolsize = 16*1024*1024
+spoolmemory = 64*1024*1024
+
+# Per archive statistics (--stats-file). cbr2cbz() fills in a stats dict with
+# these keys - stage wall times in seconds, byte and page counts
+statskeys = [
+    "extract_seconds","exclude_seconds","identify_seconds","convert_seconds"
+    ,"zip_seconds","bytes_in","bytes_out","pages","pages_excluded"
+    ,"pages_shrunk","pages_skipped","subprocesses","temp_peak_bytes"
+    ,"memory_peak_bytes","shrink_bytes","shrink_jpeg_bytes"
+    ,"optimize_seconds","pages_optimized","optimize_saved_bytes"
+    ,"pages_autogray","pages_excluded_hash","stage_wait_seconds"
+    ]
+
+# Stats counters are also updated from the shrink threads
+statslock = threading.Lock()
+
+def statsadd(stats,key,value=1):
+    # Add to a stats counter, stats may be None (not collecting)
+    if stats is not None:
+        with statslock:
+            stats[key]=stats.get(key,0)+value
+
+def statspeak(stats,key,value):
+    # Keep the largest value seen for a stats counter
+    if stats is not None:
+        with statslock:
+            stats[key]=max(stats.get(key,0),value)
+
+def treesize(top):
+    # Total size of the files under top
+    total=0
+    for root,dirs,files in os.walk(top):
+        for leaf in files:
+            try:
+                total+=os.path.getsize(os.path.join(root,leaf))
+            except OSError:
+                pass
+    return(total)
+
+# Conversion errors. cbr2cbzconvert() and Converter.convert() raise these,
+# cbr2cbz() reports them and returns False
+class ConversionError(Exception):
+    # Base class for everything that stops an archive being converted
+    def __init__(self,message,infile=None,outfile=None):
+        super().__init__(message)
+        self.infile=infile
+        self.outfile=outfile
+
+class SourceError(ConversionError):
+    # The input archive doesn't exist
+    pass
+
+class OutputExistsError(ConversionError):
+    # The output cbz already exists
+    pass
+
+class ExtractError(ConversionError):
+    # No installed extractor could read the archive
+    pass
+
+class ShrinkError(ConversionError):
+    # A shrunk page could not be put in place of the original
+    pass
+
+class ZipWriteError(ConversionError):
+    # The output cbz could not be created or written
+    pass
+
+class BrokenArchiveError(ConversionError):
+    # --keepbroken: the archive only partly extracted, outfile is the
+    # broken- prefixed cbz made from what was extracted
+    pass
+
+class WorkspaceError(ConversionError):
+    # The temp folder could not be created or emptied
+    pass
+
+def cbr2cbzclean(create=True,delete=False,tempdir=None):
     # Creates (if necessary) and cleans the temporary folder
-    if os.path.exists(cbr2cbztemp):
-        if os.path.isdir(cbr2cbztemp):
+    # tempdir defaults to the global cbr2cbztemp
+    if tempdir is None:
+        tempdir=cbr2cbztemp
+    if os.path.exists(tempdir):
+        if os.path.isdir(tempdir):
             # Clean any files/folders in temp directory
-            for fileob in os.listdir(cbr2cbztemp):
-                filename=os.path.join(cbr2cbztemp,fileob)
+            for fileob in os.listdir(tempdir):
+                filename=os.path.join(tempdir,fileob)
                 if os.path.isfile(filename):
                     os.remove(filename)
                 elif os.path.isdir(filename):
                     shutil.rmtree(filename)
                 else:
-                    exit("ERROR: Don't know how to handle removing '{0}'"
+                    raise WorkspaceError(
+                        "Don't know how to handle removing '{0}'"
                         .format(filename))
             if delete:
-                shutil.rmtree(cbr2cbztemp)
+                shutil.rmtree(tempdir)
         else:
-            exit("Temp directory {0} exists but is not a directory."
-                .format(cbr2cbztemp))
+            raise WorkspaceError(
+                "Temp directory {0} exists but is not a directory."
+                .format(tempdir))
     elif create:
         # temp folder doesn't exist
-        print("Creating {0}".format(cbr2cbztemp))
-        os.makedirs(cbr2cbztemp)
+        print("Creating {0}".format(tempdir))
+        try:
+            os.makedirs(tempdir)
+        except OSError as e:
+            raise WorkspaceError("Could not create temp directory {0}: {1}"
+                .format(tempdir,e))
     else:
         # Temp directory doesn't exist and we're not creating it
         return
 
-# Function that takes input and output file names and converts from
-# CBR to CBZ
-# Returns True if managed to create .CBZ and False on error
-def cbr2cbz(
-        infile, outfile,verbose=0,keepbroken=False
-        ,matchpagelist=[],excludepagelist=[]
-        ,shrink=False,shrinkKB=300,shrinkGray=False,shrinkQual=40
-        ,shrinkHeight=1500,whatif=False
-        ):
-    if not os.path.isfile(infile):
-        print("ERROR - infile doesn't exist")
-        return(False)
+# Each conversion unpacks into a workspace folder of its own (named for the
+# process and thread) inside one of the temp roots, picked by tempchoose()
+# for the archive's uncompressed size. A used workspace is renamed aside by
+# tempdiscard() and deleted by a background thread, so the next archive
+# doesn't wait for it
+tempdiscards = 0
+tempcleanqueue = queue.Queue()
+tempcleanthread = None
+templock = threading.Lock()
+
+def tempworkspace(root):
+    return(os.path.join(root,"w{0}-{1}".format(
+        os.getpid(),threading.get_ident())))
+
+def tempfree(root):
+    # Free bytes on the filesystem root is (or would be created) on
+    while not os.path.exists(root):
+        parent=os.path.dirname(root)
+        if parent==root:
+            return(0)
+        root=parent
+    try:
+        return(shutil.disk_usage(root).free)
+    except OSError:
+        return(0)
+
+def tempchoose(roots,needed=None,verbose=0):
+    # Workspace in the first root with room for needed bytes plus a margin,
+    # or failing that in the one with the most free space. With no size
+    # known (or just one root) the first root is used
+    if needed is None or len(roots)<2:
+        return(tempworkspace(roots[0]))
+    best=None
+    bestfree=0
+    for root in roots:
+        free=tempfree(root)
+        if free>=needed*1.2+50000000:
+            best=root
+            break
+        if best is None or free>bestfree:
+            best=root
+            bestfree=free
+    if verbose>2:
+        print("*** Temp for {0} bytes: {1}".format(needed,best))
+    return(tempworkspace(best))
+
+def tempprepare(tempdir,verbose=0):
+    # Make sure workspace tempdir exists and is empty. Leftovers (of a
+    # failed extractor or an earlier run) are discarded
+    if os.path.lexists(tempdir):
+        if not os.path.isdir(tempdir) or os.path.islink(tempdir):
+            raise WorkspaceError(
+                "Temp directory {0} exists but is not a directory."
+                .format(tempdir))
+        if not os.listdir(tempdir):
+            return
+        tempdiscard(tempdir)
+    if verbose>2:
+        print("*** Creating {0}".format(tempdir))
+    try:
+        os.makedirs(tempdir)
+    except OSError as e:
+        raise WorkspaceError("Could not create temp directory {0}: {1}"
+            .format(tempdir,e))
+
+def tempdiscard(tempdir):
+    # Rename workspace tempdir aside (same filesystem, so instant) and
+    # queue it for deleting in the background
+    global tempcleanthread, tempdiscards
+    if not os.path.lexists(tempdir):
+        return
+    with templock:
+        tempdiscards+=1
+        aside="{0}.del{1}".format(tempdir,tempdiscards)
+    try:
+        os.rename(tempdir,aside)
+    except OSError as e:
+        raise WorkspaceError("Could not move temp directory {0} aside: {1}"
+            .format(tempdir,e))
+    with templock:
+        if tempcleanthread is None:
+            tempcleanthread=threading.Thread(target=tempcleaner,daemon=True)
+            tempcleanthread.start()
+    tempcleanqueue.put(aside)
+
+def tempcleaner():
+    # Background thread deleting the workspaces tempdiscard() moved aside.
+    # Anything it can't delete is left for cbr2cbzclean() at the end
+    while True:
+        aside=tempcleanqueue.get()
+        shutil.rmtree(aside,ignore_errors=True)
+        tempcleanqueue.task_done()
+
+def tempcleanwait():
+    # Wait for the background deletes to finish
+    if tempcleanthread is not None:
+        tempcleanqueue.join()
+
+# Conversion workspaces hold the pages of the archive being converted, by
+# relative name ('/' separated) - DiskWorkspace as files in the temp folder,
+# MemoryWorkspace as bytes. Archives up to --inmemoryMB uncompressed that an
+# in-memory extractor can read go into a MemoryWorkspace, as long as the
+# memorybudget shared by all conversions allows
+class DiskWorkspace:
+    inmemory=False
+
+    def __init__(self,tempdir):
+        self.tempdir=tempdir
+
+    def names(self):
+        names=[]
+        for root,dirs,files in os.walk(self.tempdir):
+            for leaf in files:
+                names.append(os.path.relpath(
+                    os.path.join(root,leaf),self.tempdir))
+        return(sorted(names))
 
-    if os.path.exists(outfile):
-        if verbose>0:
-            # This shouldn't happen, test is done in main().
-            # Leave old check here anyway
-            print ("ERROR: {0} exists.".format(outfile))
-        return(False)
+    def path(self,name):
+        return(os.path.join(self.tempdir,name))
 
-    # Clean the temporary folder
-    cbr2cbzclean()
+    def open(self,name):
+        return(open(self.path(name),'rb'))
 
-    # Double check temp is empty
-    if len(os.listdir(cbr2cbztemp))!=0:
-        exit("ERROR: Temp folder {0} could not be emptied!"
-            .format(cbr2cbztemp))
+    def size(self,name):
+        return(os.stat(self.path(name)).st_size)
 
-    # Changing to temp directory is necessary to keep zip file paths short
-    os.chdir(cbr2cbztemp)
-    if (os.path.abspath(os.getcwd()) != os.path.abspath(cbr2cbztemp)):
-        exit("Could not change to temp directory {0}, current directory: {1}".format(cbr2cbztemp,os.getcwd()))
+    def exists(self,name):
+        return(os.path.exists(self.path(name)))
 
-    # Output folder should exist (created in main()) but leave check
-    # here anyway
-    if not os.path.isdir(os.path.dirname(outfile)):
-        os.makedirs(os.path.dirname(outfile))
+    def remove(self,name):
+        os.unlink(self.path(name))
 
-    brokenflag=False # Flag for error on extract (for --keepbroken)
-    # New - use is_zipfile. We trust zipfile more than the external unrar
-    if zipfile.is_zipfile(infile):
-        # Now using zipfile - precondition: is_zipfile() is True
-        if verbose>1:
-            print ("** Unzipping {0}".format(infile))
+    def replace(self,name,data):
+        tmpfile=self.path(name)+".optimize"
+        with open(tmpfile,'wb') as fout:
+            fout.write(data)
+        os.replace(tmpfile,self.path(name))
+        return(True)
+
+    def shrinkfiles(self,name,tag=None,ext=".jpg"):
+        # (page,shrunk page) to hand to an image backend
+        if tag is None:
+            return(self.path(name),self.path(name)+".shrink"+ext)
+        return(self.path(name),"{0}.{1}.shrink{2}".format(
+            self.path(name),tag,ext))
+
+    def shrunksize(self,shrunk):
+        return(os.stat(shrunk).st_size)
+
+    def shrinkkeep(self,name,newname,shrunk):
+        # Returns False if the page was not replaced (no room)
+        os.unlink(self.path(name)) # Not necessary on POSIX
+        os.rename(shrunk,self.path(newname))
+        return(True)
+
+    def shrinkdiscard(self,shrunk):
+        # Returns False if the shrunk page could not be removed
+        if os.path.exists(shrunk):
+            try:
+                os.unlink(shrunk)
+            except:
+                return(False)
+        return(True)
+
+    def addtozip(self,outzip,name,arcname):
+        outzip.write(self.path(name),arcname=arcname)
+
+    def close(self):
+        # The workspace folder is discarded by cbr2cbzconvert()
+        pass
+
+class MemoryWorkspace:
+    inmemory=True
+
+    def __init__(self,limit,budget=None):
+        # Holds at most limit bytes, reserved from budget (a MemoryBudget)
+        self.limit=limit
+        self.budget=budget
+        self.reserved=0
+        self.held=0 # Bytes of the pages held, at most reserved
+        self.lock=threading.Lock() # Pages are replaced from shrink threads
+        self.pages={}
+        self.times={}
+
+    def reserve(self,size):
+        # Reserve size more bytes for pages. Returns False if that goes
+        # over the limit or more than the budget has left
+        if self.reserved+size>self.limit:
+            return(False)
+        if self.budget is not None and not self.budget.reserve(size):
+            return(False)
+        self.reserved+=size
+        return(True)
+
+    def add(self,name,data,date_time=None):
+        # Pages are added within a reserve() made for them
+        self.pages[name]=data
+        self.times[name]=date_time or time.localtime()[:6]
+        self.held+=len(data)
+
+    def swap(self,name,newname,data):
+        # Replace page name by data as newname. A larger page needs the
+        # difference reserved - returns False, keeping the old page, if
+        # that can't be had
+        with self.lock:
+            grow=self.held+len(data)-len(self.pages[name])-self.reserved
+            if grow>0 and not self.reserve(grow):
+                return(False)
+            self.held+=len(data)-len(self.pages.pop(name))
+            self.times[newname]=self.times.pop(name)
+            self.pages[newname]=data
+        return(True)
+
+    def names(self):
+        return(sorted(self.pages))
+
+    def open(self,name):
+        return(io.BytesIO(self.pages[name]))
+
+    def size(self,name):
+        return(len(self.pages[name]))
+
+    def exists(self,name):
+        return(name in self.pages)
+
+    def remove(self,name):
+        self.held-=len(self.pages.pop(name))
+
+    def replace(self,name,data):
+        return(self.swap(name,name,data))
+
+    def shrinkfiles(self,name,tag=None,ext=".jpg"):
+        return(io.BytesIO(self.pages[name]),io.BytesIO())
+
+    def shrunksize(self,shrunk):
+        return(len(shrunk.getbuffer()))
+
+    def shrinkkeep(self,name,newname,shrunk):
+        return(self.swap(name,newname,shrunk.getvalue()))
+
+    def shrinkdiscard(self,shrunk):
+        return(True)
+
+    def addtozip(self,outzip,name,arcname):
+        zo=zipfile.ZipInfo(arcname,date_time=self.times[name])
+        zo.compress_type=zipfile.ZIP_STORED
+        zo.external_attr=(stat.S_IFREG|0o644)<<16
+        outzip.writestr(zo,self.pages[name])
+
+    def close(self):
+        self.pages={}
+        self.held=0
+        if self.budget is not None and self.reserved:
+            self.budget.release(self.reserved)
+        self.reserved=0
+
+class MemoryBudget:
+    # Bytes all MemoryWorkspaces together may hold. Shared between threads,
+    # and between --jobs worker processes when given a multiprocessing
+    # Value to count in
+    def __init__(self,limit,shared=None):
+        self.limit=limit
+        self.shared=shared
+        self.used=0
+        self.lock=threading.Lock()
+
+    def reserve(self,size):
+        if self.shared is not None:
+            with self.shared.get_lock():
+                if self.shared.value+size>self.limit:
+                    return(False)
+                self.shared.value+=size
+                return(True)
+        with self.lock:
+            if self.used+size>self.limit:
+                return(False)
+            self.used+=size
+            return(True)
+
+    def release(self,size):
+        if self.shared is not None:
+            with self.shared.get_lock():
+                self.shared.value-=size
+            return
+        with self.lock:
+            self.used-=size
+
+# In-memory workspace budget (--inmemoryBudgetMB)
+memorybudget = MemoryBudget(512*1000000)
+
+# Page types and sizes come from imageprobe(), no image backend needed.
+# JPEG SOFn markers that carry the frame size (not DHT, JPG or DAC)
+jpegsofmarkers = set(range(0xC0,0xD0))-{0xC4,0xC8,0xCC}
+
+def imageprobe(fin):
+    # Get (type, width, height) of an image from its header only, type
+    # named as ImageMagick does ('JPEG','PNG','GIF','WEBP'). Reads a few KB
+    # at most from the open binary file fin. Returns None for anything
+    # else (or a damaged header)
+    try:
+        head=fin.read(32)
+        if head[:8]==b'\x89PNG\r\n\x1a\n' and head[12:16]==b'IHDR':
+            (imgx,imgy)=struct.unpack('>II',head[16:24])
+            imgtype='PNG'
+        elif head[:6] in (b'GIF87a',b'GIF89a'):
+            (imgx,imgy)=struct.unpack('<HH',head[6:10])
+            imgtype='GIF'
+        elif head[:4]==b'RIFF' and head[8:12]==b'WEBP':
+            imgtype='WEBP'
+            chunk=head[12:16]
+            if chunk==b'VP8 ' and head[23:26]==b'\x9d\x01\x2a':
+                # Lossy - key frame header
+                (imgx,imgy)=struct.unpack('<HH',head[26:30])
+                imgx&=0x3fff
+                imgy&=0x3fff
+            elif chunk==b'VP8L' and head[20:21]==b'\x2f':
+                # Lossless - 14 bit width-1 and height-1
+                bits=int.from_bytes(head[21:25],'little')
+                imgx=(bits&0x3fff)+1
+                imgy=((bits>>14)&0x3fff)+1
+            elif chunk==b'VP8X':
+                # Extended - 24 bit canvas width-1 and height-1
+                imgx=int.from_bytes(head[24:27],'little')+1
+                imgy=int.from_bytes(head[27:30],'little')+1
+            else:
+                return(None)
+        elif head[:2]==b'\xff\xd8':
+            # Walk the JPEG segments to the first SOFn, seeking over the
+            # (possibly large) APPn segments
+            fin.seek(2)
+            while True:
+                marker=fin.read(2)
+                if len(marker)!=2 or marker[0]!=0xff:
+                    return(None)
+                m=marker[1]
+                while m==0xff: # Fill bytes
+                    m=fin.read(1)[0]
+                if m==0x01 or 0xd0<=m<=0xd8:
+                    # No length field
+                    continue
+                if m in (0xd9,0xda):
+                    # End of image or start of scan before any frame
+                    return(None)
+                (seglen,)=struct.unpack('>H',fin.read(2))
+                if m in jpegsofmarkers:
+                    (imgy,imgx)=struct.unpack('>xHH',fin.read(5))
+                    imgtype='JPEG'
+                    break
+                if seglen<2:
+                    return(None)
+                fin.seek(seglen-2,os.SEEK_CUR)
+        else:
+            return(None)
+    except (struct.error,IndexError,OSError):
+        return(None)
+    if imgx<1 or imgy<1:
+        return(None)
+    return((imgtype,imgx,imgy))
+
+# --shrink output formats (--shrink-format): file extension, Pillow format
+# name (with the plugin module that adds it, if not built in) and
+# ImageMagick coder
+shrinkformats = {
+    "jpeg": {"ext": ".jpg", "pillow": "JPEG", "plugin": None
+        ,"imagemagick": "JPEG"},
+    "webp": {"ext": ".webp", "pillow": "WEBP", "plugin": None
+        ,"imagemagick": "WEBP"},
+    "avif": {"ext": ".avif", "pillow": "AVIF", "plugin": "pillow_avif"
+        ,"imagemagick": "AVIF"},
+    "jxl": {"ext": ".jxl", "pillow": "JXL", "plugin": "pillow_jxl"
+        ,"imagemagick": "JXL"},
+    }
+
+# --shrink image backends
+# convert(shrinkfile,newfile,quality,height,gray,verbose,stats,fmt) writes
+# an image (shrinkformats key fmt, default jpeg) of at most height pixels
+# high to newfile and returns True on success. formats() is the set of
+# shrinkformats the backend can write. Backends with inmemory set also take
+# binary file objects for both files
+
+def imcommand(command):
+    # ImageMagick command line prefix for the configured imversion
+    if imversion == 7:
+        # IM7 ?
+        return(["magick",command])
+    else:
+        # Ubuntu IM6
+        return([command])
+
+def imconvert(
+        shrinkfile,newfile,quality,height,gray=False,verbose=0,stats=None
+        ,fmt="jpeg"):
+    # Use Imagemagick convert to recompress (and optionally gray) the page
+    subcom=imcommand("convert")+[shrinkfile,"-quality",str(quality)]
+    if gray:
+        subcom+=["-grayscale","Rec601Luma"]
+    subcom+=["-resize","x"+str(height)+">"
+        ,shrinkformats[fmt]["imagemagick"]+":"+newfile]
+    if verbose>4:
+        print ("***** {0}".format(subcom))
+    try:
+        # Call convert
+        statsadd(stats,"subprocesses")
+        output=subprocess.check_output(subcom)
+    except subprocess.CalledProcessError as e:
+        output=e.output
+        if verbose>4:
+            print(
+                "***** ERROR: CalledProcessError: convert {0}"
+                .format(shrinkfile)
+                )
+            try:
+                output=output.decode("UTF-8","ignore")
+            except:
+                print(format(sys.exc_info()[0]))
+            print ("* {0}".format(output))
+        return(False)
+    except:
+        if verbose>4:
+            print(format(sys.exc_info()[0]))
+            print("ERROR: Could not convert file {0}"
+                .format(shrinkfile))
+        return(False)
+    return(True)
+
+def pilconvert(
+        shrinkfile,newfile,quality,height,gray=False,verbose=0,stats=None
+        ,fmt="jpeg"):
+    # Decode once in process, resize to height, gray and encode as fmt.
+    # EXIF (orientation included) is kept, and the ICC profile when the
+    # colour mode is unchanged, as ImageMagick does
+    if fmt!="jpeg":
+        # Loads the plugin in this process (--jobs workers included)
+        pilformats()
+    try:
+        with Image.open(shrinkfile) as img:
+            (imgx,imgy)=img.size
+            mode=img.mode
+            keep={}
+            exif=img.getexif()
+            if exif:
+                keep["exif"]=exif
+            icc=img.info.get("icc_profile")
+            newsize=None
+            if imgy>height:
+                newsize=(max(1,round(imgx*height/imgy)),height)
+                # Let the JPEG decoder downscale by a power of 2 first
+                img.draft(img.mode,newsize)
+            if gray:
+                # Pillow's "L" is ITU-R 601-2 luma, as Rec601Luma
+                img=img.convert("L")
+            elif img.mode not in ("RGB","L","CMYK"):
+                img=img.convert("RGB")
+            if newsize:
+                img=img.resize(newsize,Image.LANCZOS)
+            if icc and img.mode==mode:
+                keep["icc_profile"]=icc
+            img.save(newfile,shrinkformats[fmt]["pillow"],quality=quality
+                ,**keep)
+    except:
+        if verbose>4:
+            print(format(sys.exc_info()[0]))
+            print("ERROR: Could not convert file {0}"
+                .format(shrinkfile))
+        return(False)
+    return(True)
+
+def imversionstring():
+    # ImageMagick version line (asked for once per process)
+    if "imagemagick" not in backendversions:
         try:
-            myzip=zipfile.ZipFile(infile,mode='r')
-            # End of unziping try
+            output=subprocess.check_output(
+                imcommand("convert")+["-version"]).decode("UTF-8","ignore")
+            backendversions["imagemagick"]=output.splitlines()[0]
         except:
-            print("Zipfile unpack error: {0}".format(sys.exc_info()[0]))
-            return(False)
-            # End of unziping except
+            backendversions["imagemagick"]="imagemagick unknown"
+    return(backendversions["imagemagick"])
+
+def pilversionstring():
+    return("Pillow "+Image.__version__)
+
+def imformats():
+    # Shrink formats ImageMagick has a writing coder for
+    if "imagemagick" not in backendformats:
+        writable=set()
         try:
-            listinf=myzip.infolist()
+            output=subprocess.check_output(
+                imcommand("convert")+["-list","format"]
+                ,stderr=subprocess.DEVNULL).decode("UTF-8","ignore")
         except:
-            print("ERROR: Zipfile list error: {0}".format(sys.exc_info()[0]))
-            return(False)
-        # Extract contents - .extract() has path safety checks,
-        # extractall() does not
-        for zi in listinf:
-            if verbose > 2:
-                print("*** Extract: {0}".format(zi.filename))
+            output=""
+        for line in output.splitlines():
+            # eg. "     WEBP* WEBP      rw+   WebP Image Format"
+            parts=line.split()
+            if len(parts)>2 and 'w' in parts[2]:
+                writable.add(parts[0].rstrip('*').upper())
+        backendformats["imagemagick"]={fmt for (fmt,info)
+            in shrinkformats.items() if info["imagemagick"] in writable}
+    return(backendformats["imagemagick"])
+
+def pilformats():
+    # Shrink formats Pillow can save, loading plugins for the missing ones
+    if "pillow" not in backendformats:
+        Image.init()
+        for info in shrinkformats.values():
+            if info["pillow"] not in Image.SAVE and info["plugin"]:
+                try:
+                    importlib.import_module(info["plugin"])
+                except ImportError:
+                    pass
+        backendformats["pillow"]={fmt for (fmt,info)
+            in shrinkformats.items() if info["pillow"] in Image.SAVE}
+    return(backendformats["pillow"])
+
+# Cache of backend version strings and format sets
+backendversions = {}
+backendformats = {}
+
+# version() identifies the encoder for the --pagecache key
+imagebackends = {
+    "imagemagick": {
+        "convert": imconvert, "version": imversionstring
+        ,"formats": imformats, "inmemory": False},
+    "pillow": {
+        "convert": pilconvert, "version": pilversionstring
+        ,"formats": pilformats, "inmemory": True},
+    }
+
+def imagebackend(name=None):
+    # Resolve name (default the imbackend global) to an imagebackends key
+    if name is None:
+        name=imbackend
+    if name == "auto":
+        if Image is None:
+            return("imagemagick")
+        return("pillow")
+    return(name)
+
+# Shrunk page cache (--pagecache). Shrunk pages are stored under the hash of
+# the original page and the shrink settings, the same page in another
+# archive is then copied from the cache instead of encoded again. Entry
+# mtimes are bumped on use, pagecacheprune() removes the least recently
+# used entries
+def pagecachekey(
+        fin,backend,shrinkQual,shrinkHeight,shrinkGray,fmt="jpeg"):
+    # fin is the original page, open for reading
+    h=hashlib.sha256()
+    for buf in iter(lambda: fin.read(streambufsize),b''):
+        h.update(buf)
+    h.update("|{0}|{1}|{2}|{3}".format(
+        shrinkQual,shrinkHeight,shrinkGray,backend["version"]()).encode())
+    if fmt!="jpeg":
+        # JPEG keys are as they were before there were other formats
+        h.update("|{0}".format(fmt).encode())
+    return(h.hexdigest())
+
+def pagecachefile(pagecache,key,ext=".jpg"):
+    # ext is the shrink format's (shrinkformats) file extension
+    return(os.path.join(pagecache,key[:2],key+ext))
+
+def pagecacheget(pagecache,key,newfile,ext=".jpg"):
+    # Copy a cached page to newfile (a path or binary file object), returns
+    # False on a cache miss
+    cachefile=pagecachefile(pagecache,key,ext)
+    try:
+        if isinstance(newfile,str):
+            shutil.copyfile(cachefile,newfile)
+        else:
+            with open(cachefile,'rb') as fin:
+                shutil.copyfileobj(fin,newfile,streambufsize)
+        os.utime(cachefile)
+    except FileNotFoundError:
+        return(False)
+    return(True)
+
+def pagecacheput(pagecache,key,newfile,ext=".jpg"):
+    # Add shrunk page newfile (a path or BytesIO) to the cache. Written
+    # under a temporary name and renamed so other workers never see a
+    # partial entry
+    cachefile=pagecachefile(pagecache,key,ext)
+    tmpfile="{0}.tmp{1}-{2}".format(
+        cachefile,os.getpid(),threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(cachefile),exist_ok=True)
+        if isinstance(newfile,str):
+            shutil.copyfile(newfile,tmpfile)
+        else:
+            with open(tmpfile,'wb') as fout:
+                fout.write(newfile.getvalue())
+        os.replace(tmpfile,cachefile)
+    except OSError:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+def pagecacheprune(pagecache,maxbytes,verbose=0):
+    # Remove least recently used entries until the cache fits in maxbytes
+    entries=[]
+    total=0
+    for root,dirs,files in os.walk(pagecache):
+        for leaf in files:
             try:
-                myzip.extract(zi)
-            except:
-                print("ERROR: Zip extracting: {0} - {1}"
-                    .format(infile,sys.exc_info()[0]))
-                myzip.close()
+                st=os.stat(os.path.join(root,leaf))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime,st.st_size,os.path.join(root,leaf)))
+            total+=st.st_size
+    if total<=maxbytes:
+        return
+    entries.sort()
+    removed=0
+    for (mtime,size,cachefile) in entries:
+        if total<=maxbytes:
+            break
+        try:
+            os.unlink(cachefile)
+        except FileNotFoundError:
+            pass
+        total-=size
+        removed+=1
+    if verbose>1:
+        print("** Page cache: removed {0} entries".format(removed))
+
+# --shrinkAutoGray. A page is taken to be gray if hardly any pixels of a
+# downsampled decode have channels further apart than graytolerance (JPEG
+# colour noise stays under it)
+graytolerance = 16
+grayfraction = 0.005
+graysample = 256 # Largest side of the decode checked
+
+def pagegray(ws,name):
+    # True if page name of workspace ws is colour but effectively gray
+    try:
+        with ws.open(name) as fin, Image.open(fin) as img:
+            if img.mode not in ("RGB","RGBA","RGBX","CMYK","YCbCr","P"):
+                # Already gray (or not something to gray)
                 return(False)
-        myzip.close()
-        # End of if is_zipfile() unzip
+            # The JPEG decoder downscales by a power of 2 for free
+            img.draft(img.mode,(graysample,graysample))
+            img=img.convert("RGB")
+            img.thumbnail((graysample,graysample),Image.NEAREST)
+            if numpy is not None:
+                pixels=numpy.asarray(img,dtype=numpy.int16)
+                spread=pixels.max(axis=2)-pixels.min(axis=2)
+                colour=numpy.count_nonzero(spread>graytolerance)
+            else:
+                (r,g,b)=img.split()
+                spread=ImageChops.subtract(
+                    ImageChops.lighter(ImageChops.lighter(r,g),b)
+                    ,ImageChops.darker(ImageChops.darker(r,g),b))
+                colour=sum(spread.histogram()[graytolerance+1:])
+            return(colour<=grayfraction*img.width*img.height)
+    except Exception:
+        return(False)
+
+def pagehash(ws,name,dhash=False):
+    # (sha256,dHash) of page name of workspace ws, as hex. With dhash the
+    # 64 bit difference hash of the page shrunk to 9x8 gray, the same for
+    # rescaled or recompressed copies of a page. None if not wanted or not
+    # an image Pillow can read
+    h=hashlib.sha256()
+    with ws.open(name) as fin:
+        for buf in iter(lambda: fin.read(streambufsize),b''):
+            h.update(buf)
+    dh=None
+    if dhash and Image is not None:
+        try:
+            with ws.open(name) as fin, Image.open(fin) as img:
+                img.draft("L",(64,64))
+                pixels=img.convert("L").resize(
+                    (9,8),Image.LANCZOS).tobytes()
+            bits=0
+            for y in range(8):
+                for x in range(8):
+                    bits=(bits<<1)|(pixels[y*9+x]>pixels[y*9+x+1])
+            dh="{0:016x}".format(bits)
+        except Exception:
+            dh=None
+    return(h.hexdigest(),dh)
+
+def shrinkencode(
+        ws,name,backend,quality,shrinkHeight,shrinkGray=False,verbose=0
+        ,pagecache=None,stats=None,tag=None,fmt="jpeg"):
+    # Encode page name of workspace ws as fmt at quality, through the page
+    # cache. Encodings with different tags can be kept side by side.
+    # Returns the shrunk page (as ws.shrinkfiles()) or None if the backend
+    # failed
+    leaf=name.split('/')[-1]
+    (source,shrunk)=ws.shrinkfiles(name,tag,shrinkformats[fmt]["ext"])
+    if pagecache:
+        with ws.open(name) as fin:
+            key=pagecachekey(
+                fin,backend,quality,shrinkHeight,shrinkGray,fmt)
+        if pagecacheget(pagecache,key,shrunk,shrinkformats[fmt]["ext"]):
+            if verbose>3:
+                print("**** Page cache hit: {0}".format(leaf.encode(
+                    'ascii', 'replace').decode('ascii', 'replace')))
+            return(shrunk)
+        converted=backend["convert"](
+            source,shrunk,quality,shrinkHeight,shrinkGray,verbose,stats,fmt)
+        if converted:
+            pagecacheput(pagecache,key,shrunk,shrinkformats[fmt]["ext"])
     else:
-        # Assume it's a RAR and launch subprocess unrar
-        if verbose>1:
-            print ("** unrar {0}".format(infile))
-        if keepbroken:
-            subcom=["unrar", "x", "-kb", infile, cbr2cbztemp]
+        converted=backend["convert"](
+            source,shrunk,quality,shrinkHeight,shrinkGray,verbose,stats,fmt)
+    if converted:
+        return(shrunk)
+    if not ws.shrinkdiscard(shrunk):
+        if verbose>0:
+            print(
+                "* Could not clean up shrink file {0}"
+                .format(shrunk)
+                )
+        raise ShrinkError("Could not clean up shrink file {0}".format(
+            shrunk))
+    return(None)
+
+def shrinkjpegsize(
+        ws,name,backend,quality,shrinkHeight,shrinkGray=False,verbose=0
+        ,pagecache=None,stats=None):
+    # Size of page name shrunk as a JPEG with the same settings, to compare
+    # other shrink formats against. None if it could not be encoded
+    shrunk=shrinkencode(
+        ws,name,backend,quality,shrinkHeight,shrinkGray,verbose,pagecache
+        ,stats,tag="ref")
+    if shrunk is None:
+        return(None)
+    size=ws.shrunksize(shrunk)
+    ws.shrinkdiscard(shrunk)
+    return(size)
+
+def shrinkfinish(
+        ws,name,newname,shrunk,quality,shrinkGray=False,verbose=0,stats=None
+        ,margin=0.9,reference=None):
+    # Keep shrunk (an encoding of page name at quality) as newname if it
+    # is under margin times the original size (or it is grayed), else
+    # discard it. reference() gives the size of the page as a JPEG, for
+    # the savings of other formats
+    leaf=name.split('/')[-1]
+    if shrunk is None:
+        statsadd(stats,"pages_skipped")
+        return
+    # Do a check the new file is smaller before replacing
+    oldsize=ws.size(name)
+    newsize=ws.shrunksize(shrunk)
+    keep=(oldsize*margin)>newsize or shrinkGray
+    if keep and not ws.shrinkkeep(name,newname,shrunk):
+        # Larger (grayed) page with no room left for it in memory
+        if verbose>2:
+            print("*** No room for shrunk page: {0}".format(leaf.encode(
+                'ascii', 'replace').decode('ascii', 'replace')))
+        statsadd(stats,"pages_skipped")
+        ws.shrinkdiscard(shrunk)
+    elif keep:
+        if stats is not None:
+            statsadd(stats,"shrink_bytes",newsize)
+            if reference is None:
+                statsadd(stats,"shrink_jpeg_bytes",newsize)
+            else:
+                statsadd(stats,"shrink_jpeg_bytes",reference() or newsize)
+        statsadd(stats,"pages_shrunk")
+        if stats is not None:
+            with statslock:
+                stats.setdefault("page_quality",{})[newname]=quality
+        if verbose>2:
+            print(
+                "*** Shrank    {3} {1}/{2} : {0}"
+                .format(leaf.encode('ascii', 'replace'
+                ).decode('ascii', 'replace')
+                , newsize, oldsize
+                , round(newsize/oldsize,2))
+                )
+    else:
+        statsadd(stats,"pages_skipped")
+        if verbose>2:
+            print(
+                "*** No shrink {3} {1}/{2} : {0}"
+                .format(leaf.encode('ascii', 'replace'
+                ).decode('ascii', 'replace')
+                , newsize, oldsize
+                , round(newsize/oldsize,2))
+                )
+        ws.shrinkdiscard(shrunk)
+
+def shrinkreference(
+        ws,name,backend,quality,shrinkHeight,shrinkGray,verbose,pagecache
+        ,stats,fmt,comparejpeg):
+    # reference for shrinkfinish(): JPEG encodes are only made for
+    # comparejpeg, a JPEG page is its own reference
+    if fmt=="jpeg" or not comparejpeg:
+        return(None)
+    return(lambda: shrinkjpegsize(
+        ws,name,backend,quality,shrinkHeight,shrinkGray,verbose,pagecache
+        ,stats))
+
+def shrinkpage(
+        ws,name,newname,backend,shrinkQual,shrinkHeight
+        ,shrinkGray=False,verbose=0,pagecache=None,stats=None,target=None
+        ,fmt="jpeg",comparejpeg=False,gray=None):
+    # Shrink page name of workspace ws with backend to format fmt, keeping
+    # the result as newname only if it is worth it. Safe to run for several
+    # pages at once as long as each has its own newname. With target
+    # (bytes) the page is encoded at the highest quality that fits in it
+    # instead of shrinkQual. With comparejpeg pages shrunk to other formats
+    # are also encoded as JPEG for the savings in stats. gray (default
+    # shrinkGray) grays this page, only shrinkGray keeps it whatever size
+    # Raises ShrinkError if a failed shrink file could not be cleaned up
+    if gray is None:
+        gray=shrinkGray
+    if target is None:
+        shrunk=shrinkencode(
+            ws,name,backend,shrinkQual,shrinkHeight,gray,verbose
+            ,pagecache,stats,fmt=fmt)
+        shrinkfinish(
+            ws,name,newname,shrunk,shrinkQual,shrinkGray,verbose,stats
+            ,reference=shrinkreference(
+                ws,name,backend,shrinkQual,shrinkHeight,gray,verbose
+                ,pagecache,stats,fmt,comparejpeg))
+        return
+
+    def encode(quality):
+        shrunk=shrinkencode(
+            ws,name,backend,quality,shrinkHeight,gray,verbose
+            ,pagecache,stats,tag=quality,fmt=fmt)
+        if shrunk is None:
+            return(None,None)
+        return(ws.shrunksize(shrunk),shrunk)
+
+    (quality,shrunk)=qualitysearch(encode,ws.shrinkdiscard,target)
+    if verbose>3:
+        print("**** Quality {0} for {1} byte target: {2}".format(
+            quality,target,name.encode('ascii', 'replace').decode(
+            'ascii', 'replace')))
+    shrinkfinish(
+        ws,name,newname,shrunk,quality,shrinkGray,verbose,stats,margin=1
+        ,reference=shrinkreference(
+            ws,name,backend,quality,shrinkHeight,gray,verbose
+            ,pagecache,stats,fmt,comparejpeg))
+
+# --target-size quality search. Encoded size grows with quality (near
+# enough monotonically), so the highest quality that fits is found by
+# bisection, stopping early once an encoding lands within 5% under the
+# target
+qualitymin = 5
+qualitymax = 95
+
+def qualitysearch(encode,discard,target,low=qualitymin,high=qualitymax):
+    # encode(quality) returns (size,result) or (None,None) on failure and
+    # discard(result) drops an encoding that wasn't chosen. Returns
+    # (quality,result) of the highest quality of at most target bytes, of
+    # the lowest quality tried if none fits or (None,None) on failure
+    fit=None # (quality,result) highest quality under target so far
+    over=None # (quality,result) lowest quality over target so far
+    while low<=high:
+        quality=(low+high)//2
+        (size,result)=encode(quality)
+        if size is None:
+            break
+        if size<=target:
+            if fit is not None:
+                discard(fit[1])
+            fit=(quality,result)
+            if size>=target*0.95:
+                break
+            low=quality+1
+        else:
+            if over is not None:
+                discard(over[1])
+            over=(quality,result)
+            high=quality-1
+    if fit is not None:
+        if over is not None:
+            discard(over[1])
+        return(fit)
+    if over is not None:
+        # Nothing fits, the smallest encoding is the closest
+        return(over)
+    return(None,None)
+
+def shrinkarchive(
+        ws,shrinkplan,backend,target,shrinkHeight,shrinkGray=False,verbose=0
+        ,pagecache=None,stats=None,shrinkpool=None,fmt="jpeg"
+        ,comparejpeg=False):
+    # Shrink the pages of shrinkplan ((name,newname,gray) tuples) at one
+    # quality, the highest that brings the whole workspace (zipped, stored)
+    # down to target bytes. Each step encodes every planned page (on
+    # shrinkpool)
+    planned={plan[0] for plan in shrinkplan}
+    fixed=22 # End of central directory
+    for name in ws.names():
+        # Stored zip entry: local header and central directory record
+        fixed+=76+2*len(zipasciiname(name).encode())
+        if name not in planned:
+            fixed+=ws.size(name)
+    sizes={name:ws.size(name) for name in planned}
+    if fixed+sum(sizes.values())<=target:
+        if verbose>2:
+            print("*** Already within {0} bytes".format(target))
+        statsadd(stats,"pages_skipped",len(shrinkplan))
+        return
+
+    def encode(quality):
+        def encodepage(plan):
+            return(shrinkencode(
+                ws,plan[0],backend,quality,shrinkHeight,plan[2],verbose
+                ,pagecache,stats,tag=quality,fmt=fmt))
+        if shrinkpool is None:
+            results=list(map(encodepage,shrinkplan))
         else:
-            subcom=["unrar", "x", infile, cbr2cbztemp]
-        if verbose>3:
-            print ("** {0}".format(subcom))
+            results=list(shrinkpool.map(encodepage,shrinkplan))
+        size=fixed
+        for ((name,newname,gray),shrunk) in zip(shrinkplan,results):
+            # Pages that don't get smaller stay as they are
+            if shrunk is None:
+                size+=sizes[name]
+            elif shrinkGray:
+                size+=ws.shrunksize(shrunk)
+            else:
+                size+=min(sizes[name],ws.shrunksize(shrunk))
+        return(size,results)
+
+    def discard(results):
+        for shrunk in results:
+            if shrunk is not None:
+                ws.shrinkdiscard(shrunk)
+
+    (quality,results)=qualitysearch(encode,discard,target)
+    if results is None:
+        results=[None]*len(shrinkplan)
+    if verbose>2:
+        print("*** Quality {0} for {1} byte target".format(quality,target))
+    for ((name,newname,gray),shrunk) in zip(shrinkplan,results):
+        shrinkfinish(
+            ws,name,newname,shrunk,quality,shrinkGray,verbose,stats,margin=1
+            ,reference=shrinkreference(
+                ws,name,backend,quality,shrinkHeight,gray,verbose
+                ,pagecache,stats,fmt,comparejpeg))
+
+# --optimize: lossless page optimisation. JPEGs are transcoded by jpegtran
+# (Huffman tables optimised, progressive, metadata dropped) and PNGs
+# re-deflated with only the chunks that make up the pixels kept. The
+# pixels stay the same, pages are only replaced when they get smaller
+pngsignature = b'\x89PNG\r\n\x1a\n'
+# Critical chunks, tRNS (transparency) which changes the pixels too and the
+# colour space chunks which change how they render. Text, time, physical
+# size and other metadata chunks are dropped
+pngkeep = {b'IHDR',b'PLTE',b'tRNS',b'IDAT',b'IEND'
+    ,b'iCCP',b'sRGB',b'gAMA',b'cHRM',b'cICP',b'sBIT'}
+
+def pngchunk(ctype,body):
+    return(struct.pack('>I',len(body))+ctype+body
+        +struct.pack('>I',zlib.crc32(ctype+body)))
+
+def pngoptimize(data):
+    # data re-deflated as one IDAT chunk with the ancillary chunks not in
+    # pngkeep dropped, or None if it isn't a PNG this can handle
+    if data[:8]!=pngsignature:
+        return(None)
+    pos=8
+    chunks=[]
+    idat=[]
+    while pos+8<=len(data):
+        (length,ctype)=struct.unpack('>I4s',data[pos:pos+8])
+        body=data[pos+8:pos+8+length]
+        if len(body)!=length:
+            return(None)
+        pos+=12+length
+        if ctype==b'IDAT':
+            idat.append(body)
+        elif ctype==b'acTL':
+            # Animated (APNG), the frames are in ancillary chunks
+            return(None)
+        elif ctype in pngkeep:
+            chunks.append((ctype,body))
+        elif not ctype[0]&0x20:
+            # Unknown critical chunk
+            return(None)
+        if ctype==b'IEND':
+            break
+    if not idat or not chunks or chunks[-1][0]!=b'IEND':
+        return(None)
+    try:
+        raw=zlib.decompress(b''.join(idat))
+    except zlib.error:
+        return(None)
+    best=None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY,zlib.Z_FILTERED):
+        deflate=zlib.compressobj(9,zlib.DEFLATED,15,9,strategy)
+        packed=deflate.compress(raw)+deflate.flush()
+        if best is None or len(packed)<len(best):
+            best=packed
+    out=[pngsignature]
+    for (ctype,body) in chunks[:-1]:
+        out.append(pngchunk(ctype,body))
+    out.append(pngchunk(b'IDAT',best))
+    out.append(pngchunk(b'IEND',b''))
+    return(b''.join(out))
+
+def jpegorientation(data):
+    # EXIF orientation of JPEG data: 1 (upright) if not recorded, None if
+    # the EXIF can't be read
+    pos=2
+    while pos+4<=len(data) and data[pos]==0xFF:
+        marker=data[pos+1]
+        if marker in (0xDA,0xD9):
+            # Start of scan, the metadata segments are all before it
+            break
+        length=struct.unpack('>H',data[pos+2:pos+4])[0]
+        segment=data[pos+4:pos+2+length]
+        pos+=2+length
+        if marker!=0xE1 or segment[:6]!=b'Exif\x00\x00':
+            continue
+        tiff=segment[6:]
+        order={b'II':'<',b'MM':'>'}.get(tiff[:2])
+        if order is None:
+            return(None)
         try:
-            output=subprocess.check_output(subcom)
-        except subprocess.CalledProcessError as e:
-            output=e.output
-            # Erroring here means that the file wasn't a zip. Couldn't unpack
-            print("ERROR: CalledProcessError: unrar {0}".format(infile))
-            if verbose > 0:
-                try:
-                    output=output.decode("UTF-8","ignore")
-                except:
-                    print(format(sys.exc_info()[0]))
-                print ("* {0}".format(output))
-            if keepbroken:
-                brokenflag=True
-                print("* KEEPBROKEN: Continue to zip content {0}".format(infile))
+            ifd=struct.unpack(order+'I',tiff[4:8])[0]
+            count=struct.unpack(order+'H',tiff[ifd:ifd+2])[0]
+            for i in range(count):
+                entry=tiff[ifd+2+12*i:ifd+14+12*i]
+                if struct.unpack(order+'H',entry[:2])[0]==0x0112:
+                    return(struct.unpack(order+'H',entry[8:10])[0])
+        except struct.error:
+            return(None)
+    return(1)
+
+def jpegoptimize(data,verbose=0,stats=None):
+    # data losslessly transcoded by jpegtran, or None if jpegtran isn't
+    # installed or failed. Only the ICC profile is kept of the metadata, so
+    # pages that rely on EXIF orientation are left alone
+    if data[:2]!=b'\xff\xd8' or not shutil.which("jpegtran"):
+        return(None)
+    if jpegorientation(data)!=1:
+        return(None)
+    subcom=["jpegtran","-copy","icc","-optimize","-progressive"]
+    if verbose>4:
+        print ("***** {0}".format(subcom))
+    try:
+        statsadd(stats,"subprocesses")
+        output=subprocess.run(subcom,input=data,stdout=subprocess.PIPE
+            ,stderr=subprocess.DEVNULL,check=True).stdout
+    except (OSError,subprocess.CalledProcessError):
+        return(None)
+    if output[:2]!=b'\xff\xd8':
+        return(None)
+    return(output)
+
+def optimizedata(data,verbose=0,stats=None):
+    # data (a page) optimised, or None if it couldn't be made smaller
+    if data[:8]==pngsignature:
+        new=pngoptimize(data)
+    else:
+        new=jpegoptimize(data,verbose,stats)
+    if new is None or len(new)>=len(data):
+        return(None)
+    statsadd(stats,"pages_optimized")
+    statsadd(stats,"optimize_saved_bytes",len(data)-len(new))
+    return(new)
+
+def optimizepage(ws,name,verbose=0,stats=None):
+    # Optimise page name of workspace ws in place
+    with ws.open(name) as fin:
+        data=fin.read()
+    new=optimizedata(data,verbose,stats)
+    if new is None:
+        return
+    if verbose>2:
+        print("*** Optimized {0}/{1} : {2}".format(len(new),len(data)
+            ,name.encode('ascii', 'replace').decode('ascii', 'replace')))
+    ws.replace(name,new)
+
+def patternliteral(pattern):
+    # The text regular expression pattern matches if it is a plain literal
+    # (any metacharacters escaped), otherwise None
+    text=[]
+    i=0
+    while i<len(pattern):
+        ch=pattern[i]
+        if ch=='\\':
+            if i+1<len(pattern) and pattern[i+1].isascii() and not (
+                    pattern[i+1].isalnum() or pattern[i+1]=='\n'):
+                text.append(pattern[i+1])
+                i+=2
+                continue
+            return(None)
+        if ch in '.^$*+?{}[]|()':
+            return(None)
+        text.append(ch)
+        i+=1
+    return(''.join(text))
+
+def trieregex(literals):
+    # A regular expression matching any of literals, with common prefixes
+    # shared so re tries each character once rather than once per literal
+    trie={}
+    for literal in literals:
+        node=trie
+        for ch in literal:
+            node=node.setdefault(ch,{})
+        node['']={} # A literal ends here, longer ones needn't be searched
+    def build(node):
+        if '' in node:
+            return('')
+        alts=[re.escape(ch)+build(node[ch]) for ch in sorted(node)]
+        if len(alts)==1:
+            return(alts[0])
+        return('(?:'+'|'.join(alts)+')')
+    return(build(trie))
+
+# Match/exclude rules (-m, -e, --matchpage, ...) as one matcher. search(text)
+# is True if any of the rules re.search() text. Plain literal rules (eg.
+# Thumbs\.db) go into one prefix shared regex, the other rules are
+# alternated into one more, so a file name is scanned a couple of times
+# whatever the number of rules. Rules with their own flags or groups (which
+# can't be alternated) and already compiled rules are searched one by one
+class PatternSet:
+    def __init__(self,patterns=[],casesensitive=False):
+        if casesensitive:
+            reflags= 0
+        else:
+            reflags= re.I
+        self.casesensitive=casesensitive
+        self.patterns=[]
+        self.separate=[]
+        literals=[]
+        combinable=[]
+        for pattern in patterns:
+            if isinstance(pattern,re.Pattern):
+                self.patterns.append(pattern.pattern)
+                self.separate.append(pattern)
+                continue
+            pattern=pattern.rstrip()
+            self.patterns.append(pattern)
+            literal=patternliteral(pattern)
+            if literal is not None:
+                literals.append(literal)
+                continue
+            compiled=re.compile(pattern,reflags)
+            if compiled.groups or re.match(r'\(\?[aiLmsux]+\)',pattern):
+                self.separate.append(compiled)
             else:
-                return(False) # Failed via unrar subprocess error
+                combinable.append(pattern)
+        self.literal=None
+        if literals:
+            self.literal=re.compile(trieregex(literals),reflags)
+        self.combined=None
+        if combinable:
+            self.combined=re.compile(
+                '|'.join('(?:'+x+')' for x in combinable),reflags)
+
+    def search(self,text):
+        if self.literal is not None and self.literal.search(text):
+            return(True)
+        if self.combined is not None and self.combined.search(text):
+            return(True)
+        for compiled in self.separate:
+            if compiled.search(text):
+                return(True)
+        return(False)
+
+    def __len__(self):
+        return(len(self.patterns))
+
+    def __repr__(self):
+        return("PatternSet({0!r},casesensitive={1})".format(
+            self.patterns,self.casesensitive))
+
+    def __reduce__(self):
+        # Pickle (for --jobs workers) as the rules, compiled again on load
+        return(PatternSet,(self.patterns,self.casesensitive))
+
+def patternset(patterns,casesensitive=False):
+    # PatternSet from a list of rule strings or compiled patterns, passing
+    # a PatternSet through as it is
+    if isinstance(patterns,PatternSet):
+        return(patterns)
+    return(PatternSet(patterns,casesensitive))
+
+def pageexcluded(leaf,matchpagelist,excludepagelist):
+    # Returns True if page file name leaf is rejected by the page filters
+    # (PatternSets). Match wins, then exclude overrides
+    # leaf for now, consider using folder as well
+    if matchpagelist and not matchpagelist.search(leaf):
+        return(True)
+    if excludepagelist and excludepagelist.search(leaf):
+        return(True)
+    return(False)
+
+def zipasciiname(name):
+    # Force archive names to be ascii
+    name=name.replace(u'\xa0', ' ')
+    return(name.encode('ascii', 'replace').decode('ascii', 'replace'))
+
+def zipsafename(name):
+    # Clean a zip member name the same way ZipFile.extract() does, so a
+    # streamed member ends up with the name it would have had if extracted
+    # and re-added from the temp folder. Returns '' for unusable names
+    name=os.path.splitdrive(name)[1]
+    return('/'.join(
+        x for x in name.split('/') if x not in ('', os.path.curdir, os.path.pardir)
+        ))
+
+def cbr2cbzzipopen(outfile,verbose=0):
+    # Create the output cbz using zipfile. Returns None on error
+
+    # For Python < 3.5 use append mode (should be safe), use x mode for >3.5
+    if ((sys.version_info[0]==3) and (sys.version_info[1]<5)):
+        zipmode='a'
+    else:
+        zipmode='x'
+    
+    if verbose>1:
+        print ("** Creating with zipfile: {0}, mode '{1}'".format(outfile,zipmode))
+    try:
+        outzip=zipfile.ZipFile(outfile,mode=zipmode,compression=zipfile.ZIP_STORED,strict_timestamps=False)
+
+    except FileExistsError:
+        # This really shouldn't happen, tested in main() and earlier
+        # in this function
+        print ("ERROR: File exists: {0}".format(outfile))
+        return(None)
+    except NameError as e:
+        print("ERROR: Zipfile creation NameError")
+        print(e)
+        return(None)
+    except:
+        print("ERROR: Zipfile creation error")
+        print(sys.exc_info()[0])
+        return(None)
+    return(outzip)
+
+def ziprawcopyable(zi,arcname):
+    # True if member zi can be copied verbatim into the output under
+    # arcname: already stored, not encrypted, no trailing data descriptor
+    # and not renamed
+    return(
+        zi.compress_type==zipfile.ZIP_STORED
+        and not zi.flag_bits & 0x09 # 0x01 encrypted, 0x08 data descriptor
+        and zi.filename==arcname
+        )
+
+def ziprawcopy(rawin,zi,outzip):
+    # Copy a stored member's local header and data bytes verbatim from the
+    # open input file rawin into outzip, reusing the CRC and sizes from the
+    # input central directory (no decompression, no CRC calculation).
+    # Precondition: ziprawcopyable(zi,zi.filename)
+    # This appends to the ZipFile by hand, using the same attributes
+    # ZipFile.write() maintains
+    rawin.seek(zi.header_offset)
+    header=rawin.read(zipfile.sizeFileHeader)
+    if len(header)!=zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile("Truncated local header: {0}"
+            .format(zi.filename))
+    (sig,_,_,_,method,_,_,_,_,_,namelen,extralen)=struct.unpack(
+        zipfile.structFileHeader,header)
+    if sig!=zipfile.stringFileHeader or method!=zipfile.ZIP_STORED:
+        raise zipfile.BadZipFile("Bad local header: {0}".format(zi.filename))
+    header+=rawin.read(namelen+extralen)
+    if header[zipfile.sizeFileHeader:zipfile.sizeFileHeader+namelen]!=(
+            zi.filename.encode('ascii')):
+        raise zipfile.BadZipFile("Local header name mismatch: {0}"
+            .format(zi.filename))
+
+    # The central directory entry keeps the input's attributes, less any
+    # zip64 record (id 1) - that describes the input's offsets and sizes,
+    # ZipFile adds its own where needed
+    zo=zipfile.ZipInfo(zi.filename,date_time=zi.date_time)
+    zo.compress_type=zipfile.ZIP_STORED
+    zo.create_system=zi.create_system
+    zo.create_version=zi.create_version
+    zo.external_attr=zi.external_attr
+    zo.internal_attr=zi.internal_attr
+    zo.comment=zi.comment
+    zo.flag_bits=zi.flag_bits
+    zo.extract_version=zi.extract_version
+    zo.extra=zipfile._strip_extra(zi.extra,(1,))
+    zo.CRC=zi.CRC
+    zo.compress_size=zi.compress_size
+    zo.file_size=zi.file_size
+
+    outzip.fp.seek(outzip.start_dir)
+    zo.header_offset=outzip.fp.tell()
+    outzip.fp.write(header)
+    remaining=zi.compress_size
+    while remaining>0:
+        buf=rawin.read(min(remaining,streambufsize))
+        if not buf:
+            raise zipfile.BadZipFile("Truncated member data: {0}"
+                .format(zi.filename))
+        outzip.fp.write(buf)
+        remaining-=len(buf)
+    outzip.start_dir=outzip.fp.tell()
+    outzip.filelist.append(zo)
+    outzip.NameToInfo[zo.filename]=zo
+    outzip._didModify=True
+
+# Streaming repack of a zip input - precondition: is_zipfile() is True
+# Members go straight from the input zip into the output zip, no temp files.
+# Already stored members are copied as raw bytes, the rest are decompressed
+# and stored. Only usable when pages don't need to be modified (no --shrink)
+# Returns True if managed to create .CBZ, raises ConversionError on error
+def cbr2cbzzipstream(
+        infile, outfile,verbose=0
+        ,matchpagelist=[],excludepagelist=[],stats=None,optimize=False
+        ,jobs=1):
+    # With optimize every member is read whole and optimised (--optimize)
+    # on a pool of jobs threads before it is stored
+    if verbose>1:
+        print ("** Streaming zip {0}".format(infile))
+    stagestart=time.perf_counter()
+    try:
+        myzip=zipfile.ZipFile(infile,mode='r')
+        listinf=myzip.infolist()
+        rawin=open(infile,'rb')
+    except:
+        raise ExtractError("Zipfile list error: {0}".format(sys.exc_info()[0])
+            ,infile,outfile)
+    statsadd(stats,"extract_seconds",time.perf_counter()-stagestart)
+
+    # Work out the members to copy, using the names they'd be extracted as.
+    # Later duplicates win, as they'd overwrite earlier ones on extract
+    stagestart=time.perf_counter()
+    members={}
+    for zi in listinf:
+        if zi.is_dir():
+            continue
+        name=zipsafename(zi.filename)
+        if name=='':
+            continue
+        statsadd(stats,"pages")
+        leaf=name.split('/')[-1]
+        if pageexcluded(leaf,matchpagelist,excludepagelist):
+            if verbose>2:
+                print("*** Excluding page: {0}".format(leaf))
+            statsadd(stats,"pages_excluded")
+            continue
+        members[name]=zi
+    statsadd(stats,"exclude_seconds",time.perf_counter()-stagestart)
+
+    stagestart=time.perf_counter()
+    outzip=cbr2cbzzipopen(outfile,verbose)
+    if outzip is None:
+        rawin.close()
+        myzip.close()
+        raise ZipWriteError("Could not create {0}".format(outfile)
+            ,infile,outfile)
+
+    def optimizeread(name):
+        # Member name optimised, None if it wasn't (or couldn't be read,
+        # the plain copy below then reports it)
+        start=time.perf_counter()
+        try:
+            with myzip.open(members[name]) as fin:
+                data=fin.read()
+            data=optimizedata(data,verbose,stats)
+        except Exception:
+            data=None
+        statsadd(stats,"optimize_seconds",time.perf_counter()-start)
+        return(data)
+
+    def optimizedmembers(names,pool):
+        # (name,optimised data or None) in order, a window at a time so
+        # only a few members are held in memory
+        window=2*max(1,jobs)
+        for i in range(0,len(names),window):
+            yield from zip(names[i:i+window]
+                ,pool.map(optimizeread,names[i:i+window]))
+
+    # Same sort order as the extract method
+    optimizepool=None
+    if optimize:
+        optimizepool=concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1,jobs))
+        pages=optimizedmembers(sorted(members),optimizepool)
+    else:
+        pages=((name,None) for name in sorted(members))
+    for (name,data) in pages:
+        zi=members[name]
+        try:
+            arcname=zipasciiname(name)
+            if data is not None:
+                zo=zipfile.ZipInfo(arcname,date_time=zi.date_time)
+                zo.compress_type=zipfile.ZIP_STORED
+                zo.external_attr=(stat.S_IFREG|0o644)<<16
+                outzip.writestr(zo,data)
+                if verbose>2:
+                    print("*** Adding optimized: {0}".format(zo.filename))
+                continue
+            if ziprawcopyable(zi,arcname):
+                ziprawcopy(rawin,zi,outzip)
+                if verbose>2:
+                    print("*** Copying raw: {0}".format(arcname))
+                continue
+            zo=zipfile.ZipInfo(arcname,date_time=zi.date_time)
+            zo.compress_type=zipfile.ZIP_STORED
+            zo.external_attr=(stat.S_IFREG|0o644)<<16
+            # Known size lets zipfile decide on zip64 up front
+            zo.file_size=zi.file_size
+            with myzip.open(zi) as fin, outzip.open(zo,mode='w') as fout:
+                shutil.copyfileobj(fin,fout,streambufsize)
+            if verbose>2:
+                print(
+                    "*** Adding: {0}".format(zo.filename)
+                )
         except:
-            print(format(sys.exc_info()[0]))
-            print("No process output available")
-            return(False) # Failed via unrar misc error
-        # No exception on subprocess, try to display output
+            if optimizepool is not None:
+                optimizepool.shutdown()
+            outzip.close()
+            rawin.close()
+            myzip.close()
+            os.remove(outfile)
+            raise ZipWriteError("Error adding file:{0} {1}".format(
+                name.encode('ascii', 'replace').decode('ascii', 'replace')
+                ,sys.exc_info()[0]),infile,outfile)
+    if optimizepool is not None:
+        optimizepool.shutdown()
+    outzip.close()
+    rawin.close()
+    myzip.close()
+    statsadd(stats,"zip_seconds",time.perf_counter()-stagestart)
+    return(True)
+
+def rarlist(infile,verbose=0,stats=None):
+    # List a RAR archive with unrar's technical listing. Returns a list of
+    # dicts (name, type, size, crc, date_time) in archive order, or None if
+    # it could not be listed
+    subcom=["unrar","lt","-p-","--",infile]
+    if verbose>3:
+        print ("** {0}".format(subcom))
+    try:
+        statsadd(stats,"subprocesses")
+        output=subprocess.check_output(subcom,stderr=subprocess.DEVNULL)
+    except:
+        if verbose>1:
+            print("** Could not list {0}: {1}".format(infile,sys.exc_info()[0]))
+        return(None)
+    members=[]
+    member=None
+    for line in output.split(b'\n'):
+        (key,sep,value)=line.strip().partition(b': ')
+        if not sep:
+            continue
+        key=key.decode("UTF-8","ignore")
+        if key=="Name":
+            # Names as unrar would create them on disk
+            member={"name":os.fsdecode(value),"type":None,"size":None
+                ,"crc":None,"date_time":None}
+            members.append(member)
+        elif member is None:
+            continue
+        elif key=="Type":
+            member["type"]=value.decode("UTF-8","ignore")
+        elif key=="Size":
+            member["size"]=int(value)
+        elif key=="CRC32":
+            member["crc"]=int(value,16)
+        elif key=="mtime":
+            try:
+                member["date_time"]=time.strptime(
+                    value[:19].decode("UTF-8","ignore"),"%Y-%m-%d %H:%M:%S")[:6]
+            except ValueError:
+                pass
+    return(members)
+
+def copybytes(fin,fout,size):
+    # Copy exactly size bytes from fin to fout through a bounded buffer
+    while size>0:
+        buf=fin.read(min(size,streambufsize))
+        if not buf:
+            raise EOFError("Stream ended {0} bytes early".format(size))
+        if fout is not None:
+            fout.write(buf)
+        size-=len(buf)
+
+# Streaming conversion of a RAR input
+# Lists the archive, then has a single "unrar p" write every file to a pipe
+# in archive order. Members go from the pipe into the output zip in the same
+# sort order as the extract method; members that arrive early are spooled
+# (in memory, or in tempdir when large). Only usable when pages don't need
+# to be modified (no --shrink)
+# Returns True if managed to create .CBZ and None if the archive can't be
+# streamed (caller falls back to extracting it). Raises ConversionError on
+# other errors
+def cbr2cbzrarstream(
+        infile, outfile,tempdir,verbose=0
+        ,matchpagelist=[],excludepagelist=[],stats=None,listing=None
+        ):
+    # listing is infile's rarlist() if already made
+    if listing is None:
+        stagestart=time.perf_counter()
+        listing=rarlist(infile,verbose,stats)
+        statsadd(stats,"extract_seconds",time.perf_counter()-stagestart)
+    if not listing:
+        return(None)
+
+    # Work out the members to write. Later duplicates win, as they'd
+    # overwrite earlier ones on extract
+    stagestart=time.perf_counter()
+    pages=0
+    excluded=0
+    last={}
+    for (i,member) in enumerate(listing):
+        if member["type"]=="Directory":
+            continue
+        if member["type"]!="File" or member["size"] is None:
+            # Links etc. - leave to unrar x
+            if verbose>1:
+                print("** Can't stream {0} member {1}".format(
+                    member["type"],member["name"]))
+            return(None)
+        name=zipsafename(member["name"])
+        if name=='':
+            continue
+        pages+=1
+        if pageexcluded(name.split('/')[-1],matchpagelist,excludepagelist):
+            if verbose>2:
+                print("*** Excluding page: {0}".format(name.split('/')[-1]))
+            excluded+=1
+            continue
+        last[name]=i
+    wanted=sorted(last)
+    statsadd(stats,"exclude_seconds",time.perf_counter()-stagestart)
+
+    if verbose>1:
+        print ("** Streaming unrar {0}".format(infile))
+    outzip=cbr2cbzzipopen(outfile,verbose)
+    if outzip is None:
+        raise ZipWriteError("Could not create {0}".format(outfile)
+            ,infile,outfile)
+
+    def addmember(name,member,fin):
+        zo=zipfile.ZipInfo(zipasciiname(name)
+            ,date_time=member["date_time"] or time.localtime()[:6])
+        zo.compress_type=zipfile.ZIP_STORED
+        zo.external_attr=(stat.S_IFREG|0o644)<<16
+        zo.file_size=member["size"]
+        with outzip.open(zo,mode='w') as fout:
+            copybytes(fin,fout,member["size"])
+        if member["crc"] is not None and zo.CRC!=member["crc"]:
+            raise zipfile.BadZipFile("CRC mismatch: {0}".format(name))
+        if verbose>2:
+            print("*** Adding: {0}".format(zo.filename))
+
+    subcom=["unrar","p","-inul","-p-","--",infile]
+    if verbose>3:
+        print ("** {0}".format(subcom))
+    stagestart=time.perf_counter()
+    spooled={}
+    spilled=0 # Bytes of spooled members in the temp folder
+    held=0 # Bytes of spooled members in memory (reserved in memorybudget)
+    nextname=0
+    proc=None
+    try:
+        statsadd(stats,"subprocesses")
+        proc=subprocess.Popen(subcom,stdout=subprocess.PIPE
+            ,stderr=subprocess.DEVNULL)
+        for (i,member) in enumerate(listing):
+            if member["type"]!="File":
+                continue
+            name=zipsafename(member["name"])
+            if last.get(name)!=i:
+                # Excluded or overwritten later - drop the bytes
+                copybytes(proc.stdout,None,member["size"])
+                continue
+            if name==wanted[nextname]:
+                addmember(name,member,proc.stdout)
+                nextname+=1
+                # Catch up with anything that arrived early
+                while nextname<len(wanted) and wanted[nextname] in spooled:
+                    (spoolmember,spool,reserved)=spooled.pop(
+                        wanted[nextname])
+                    try:
+                        spool.seek(0)
+                        addmember(wanted[nextname],spoolmember,spool)
+                    finally:
+                        spool.close()
+                        if reserved:
+                            memorybudget.release(reserved)
+                            held-=reserved
+                        else:
+                            spilled-=spoolmember["size"]
+                    nextname+=1
+            else:
+                spool=tempfile.SpooledTemporaryFile(
+                    max_size=spoolsize,dir=tempdir)
+                size=member["size"]
+                reserved=0
+                if size<=spoolsize and held+size<=spoolmemory and (
+                        memorybudget.reserve(size)):
+                    reserved=size
+                    held+=size
+                    statspeak(stats,"memory_peak_bytes",held)
+                else:
+                    spool.rollover()
+                    spilled+=size
+                    statspeak(stats,"temp_peak_bytes",spilled)
+                spooled[name]=(member,spool,reserved)
+                copybytes(proc.stdout,spool,size)
+        if proc.stdout.read(1):
+            raise zipfile.BadZipFile("More data than listed")
+        proc.stdout.close()
+        if proc.wait()!=0 or nextname!=len(wanted):
+            raise subprocess.CalledProcessError(proc.returncode,subcom)
+    except:
+        if verbose>0:
+            print("* Streaming unrar failed, extracting instead: {0} - {1}"
+                .format(infile,sys.exc_info()[0]))
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+        for (spoolmember,spool,reserved) in spooled.values():
+            spool.close()
+            if reserved:
+                memorybudget.release(reserved)
+        outzip.close()
+        os.remove(outfile)
+        return(None)
+    outzip.close()
+    statsadd(stats,"zip_seconds",time.perf_counter()-stagestart)
+    statsadd(stats,"pages",pages)
+    statsadd(stats,"pages_excluded",excluded)
+    return(True)
+
+# Archive extractors. extract(infile,tempdir,keepbroken,verbose,stats
+# ,pagefilter,listing) unpacks infile into the (empty) tempdir and returns
+# True, "broken" if with keepbroken it kept going past errors, or False on
+# failure. pagefilter(leaf), if given, returns True for pages to leave out.
+# Those are picked from the archive listing and never extracted. listing is
+# a RAR's rarlist() if already made (unrar lists it otherwise)
+# command is the external program needed, if any
+
+def pagecount(leaf,pagefilter,verbose=0,stats=None):
+    # Count a page, returns True if pagefilter leaves it out
+    if pagefilter and pagefilter(leaf):
+        if verbose>2:
+            print("*** Excluding page: {0}".format(leaf))
+        statsadd(stats,"pages")
+        statsadd(stats,"pages_excluded")
+        return(True)
+    return(False)
+
+def pageselect(names,pagefilter,verbose=0,stats=None):
+    # Apply pagefilter to a list of archive member names (files only).
+    # Returns the names to extract, or None to extract everything
+    if pagefilter is None:
+        return(None)
+    selected=[x for x in names
+        if not pagecount(x.split('/')[-1],pagefilter,verbose,stats)]
+    if len(selected)==len(names):
+        return(None)
+    return(selected)
+
+def pagelistable(names):
+    # True if names can be handed to an external extractor as a list file.
+    # unrar, 7z and bsdtar all read list file lines as wildcards
+    return(not any(re.search(r'[*?\[\\\n]',x) for x in names))
+
+def extractlistfile(tempdir,names):
+    # Write names one per line to a list file beside tempdir (not in it,
+    # everything in tempdir goes into the cbz). Returns its path
+    (fd,listfile)=tempfile.mkstemp(
+        prefix=os.path.basename(tempdir)+"-",suffix=".list"
+        ,dir=os.path.dirname(tempdir))
+    with os.fdopen(fd,"w",encoding="UTF-8",errors="surrogateescape") as f:
+        f.write("".join(x+"\n" for x in names))
+    return(listfile)
+
+def extractzipfile(
+        infile,tempdir,keepbroken=False,verbose=0,stats=None,pagefilter=None
+        ,listing=None):
+    # Now using zipfile - precondition: is_zipfile() is True
+    if verbose>1:
+        print ("** Unzipping {0}".format(infile))
+    try:
+        myzip=zipfile.ZipFile(infile,mode='r')
+        # End of unziping try
+    except:
+        print("Zipfile unpack error: {0}".format(sys.exc_info()[0]))
+        return(False)
+        # End of unziping except
+    try:
+        listinf=myzip.infolist()
+    except:
+        print("ERROR: Zipfile list error: {0}".format(sys.exc_info()[0]))
+        return(False)
+    # Extract contents - .extract() has path safety checks,
+    # extractall() does not
+    for zi in listinf:
+        leaf=zipsafename(zi.filename).split('/')[-1]
+        if not zi.is_dir() and leaf and pagecount(
+                leaf,pagefilter,verbose,stats):
+            continue
         if verbose > 2:
+            print("*** Extract: {0}".format(zi.filename))
+        try:
+            myzip.extract(zi,tempdir)
+        except:
+            print("ERROR: Zip extracting: {0} - {1}"
+                .format(infile,sys.exc_info()[0]))
+            myzip.close()
+            return(False)
+    myzip.close()
+    return(True)
+
+def extracttarfile(
+        infile,tempdir,keepbroken=False,verbose=0,stats=None,pagefilter=None
+        ,listing=None):
+    if verbose>1:
+        print ("** Untarring {0}".format(infile))
+    try:
+        with tarfile.open(infile,mode='r') as mytar:
+            for ti in mytar:
+                # Regular files and folders only, with the same path
+                # clean up as zip members
+                name=zipsafename(ti.name)
+                if name=='' or not (ti.isfile() or ti.isdir()):
+                    continue
+                if ti.isfile() and pagecount(
+                        name.split('/')[-1],pagefilter,verbose,stats):
+                    continue
+                if verbose > 2:
+                    print("*** Extract: {0}".format(ti.name))
+                if ti.isdir():
+                    os.makedirs(os.path.join(tempdir,name),exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(os.path.join(tempdir,name))
+                    ,exist_ok=True)
+                with mytar.extractfile(ti) as fin, open(
+                        os.path.join(tempdir,name),'wb') as fout:
+                    shutil.copyfileobj(fin,fout,streambufsize)
+    except:
+        print("ERROR: Tar extracting: {0} - {1}"
+            .format(infile,sys.exc_info()[0]))
+        return(False)
+    return(True)
+
+def extractcommand(infile,subcom,keepbroken=False,verbose=0,stats=None):
+    # Run an external extractor command
+    if verbose>3:
+        print ("** {0}".format(subcom))
+    try:
+        statsadd(stats,"subprocesses")
+        output=subprocess.check_output(subcom,stdin=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        output=e.output
+        # Erroring here means that the file couldn't be unpacked
+        print("ERROR: CalledProcessError: {0} {1}".format(subcom[0],infile))
+        if verbose > 0:
             try:
                 output=output.decode("UTF-8","ignore")
             except:
                 print(format(sys.exc_info()[0]))
-            print ("*** {0}".format(output))
-        # End if is_zipfile() unrar method
+            print ("* {0}".format(output))
+        if keepbroken:
+            return("broken")
+        else:
+            return(False) # Failed via subprocess error
+    except:
+        print(format(sys.exc_info()[0]))
+        print("No process output available")
+        return(False) # Failed via misc error
+    # No exception on subprocess, try to display output
+    if verbose > 2:
+        try:
+            output=output.decode("UTF-8","ignore")
+        except:
+            print(format(sys.exc_info()[0]))
+        print ("*** {0}".format(output))
+    return(True)
+
+def extractlisted(
+        infile,tempdir,subcom,listcom,names,keepbroken=False,verbose=0
+        ,stats=None,pagefilter=None):
+    # Run the external extractor command subcom, or listcom(listfile) to
+    # extract just the pages pagefilter keeps when names (the archive's
+    # files, None if it couldn't be listed) allows
+    if names is not None and pagelistable(names):
+        selected=pageselect(names,pagefilter,verbose,stats)
+        if selected is not None:
+            if not selected:
+                # Every page excluded, an empty cbz as before
+                return(True)
+            listfile=extractlistfile(tempdir,selected)
+            try:
+                return(extractcommand(infile,listcom(listfile)
+                    ,keepbroken,verbose,stats))
+            finally:
+                os.remove(listfile)
+    return(extractcommand(infile,subcom,keepbroken,verbose,stats))
+
+def extractunrar(
+        infile,tempdir,keepbroken=False,verbose=0,stats=None,pagefilter=None
+        ,listing=None):
+    if verbose>1:
+        print ("** unrar {0}".format(infile))
+    if keepbroken:
+        subcom=["unrar", "x", "-kb"]
+    else:
+        subcom=["unrar", "x"]
+    names=None
+    if pagefilter:
+        if listing is None:
+            listing=rarlist(infile,verbose,stats)
+        if listing:
+            names=[x["name"] for x in listing if x["type"]!="Directory"]
+    return(extractlisted(infile,tempdir,subcom+[infile,tempdir]
+        ,lambda listfile: subcom+["-n@"+listfile,infile,tempdir]
+        ,names,keepbroken,verbose,stats,pagefilter))
+
+def list7z(infile,verbose=0,stats=None):
+    # Names of the files in an archive from 7z's technical listing, or None
+    subcom=[extractorcommand("7z"),"l","-slt","-ba","--",infile]
+    if verbose>3:
+        print ("** {0}".format(subcom))
+    try:
+        statsadd(stats,"subprocesses")
+        output=subprocess.check_output(subcom,stdin=subprocess.DEVNULL
+            ,stderr=subprocess.DEVNULL)
+    except:
+        return(None)
+    names=[]
+    name=None
+    for line in output.split(b'\n')+[b'']:
+        line=line.rstrip(b'\r')
+        if line.startswith(b'Path = '):
+            name=os.fsdecode(line[7:])
+        elif line.startswith(b'Folder = +') or (
+                line.startswith(b'Attributes = D')):
+            name=None
+        elif line==b'' and name is not None:
+            names.append(name)
+            name=None
+    return(names)
+
+def extract7z(
+        infile,tempdir,keepbroken=False,verbose=0,stats=None,pagefilter=None
+        ,listing=None):
+    if verbose>1:
+        print ("** 7z {0}".format(infile))
+    subcom=[extractorcommand("7z"),"x","-y","-bd","-o"+tempdir]
+    names=None
+    if pagefilter:
+        names=list7z(infile,verbose,stats)
+    return(extractlisted(infile,tempdir,subcom+["--",infile]
+        ,lambda listfile: subcom+["-scsUTF-8","--",infile,"@"+listfile]
+        ,names,keepbroken,verbose,stats,pagefilter))
+
+def listbsdtar(infile,verbose=0,stats=None):
+    # Names of the files in an archive from bsdtar's listing, or None
+    subcom=["bsdtar","-t","-f",infile]
+    if verbose>3:
+        print ("** {0}".format(subcom))
+    try:
+        statsadd(stats,"subprocesses")
+        output=subprocess.check_output(subcom,stdin=subprocess.DEVNULL
+            ,stderr=subprocess.DEVNULL)
+    except:
+        return(None)
+    return([os.fsdecode(x) for x in output.split(b'\n')
+        if x and not x.endswith(b'/')])
 
-    # Check what files need to be excluded
-    for root,dirs,files in os.walk(cbr2cbztemp):
-        dirs.sort()
-        files.sort()
-        for leaf in files:
-            if matchpagelist:
-                epf = True # exclude page flag
-                for m in matchpagelist:
-                    # leaf for now, consider using folder as well
-                    if re.search(m,leaf)!=None:
-                        epf=False
-                        break
-            else:
-                epf=False
-
-            if excludepagelist and not epf:
-                for m in excludepagelist:
-                    # leaf for now, consider using folder as well
-                    if re.search(m,leaf)!=None:
-                        epf=True
-                        break
-            if epf:
-                if verbose>2:
-                    print("*** Excluding page: {0}".format(leaf))
-                os.unlink(os.path.join(root,leaf))
+def extractbsdtar(
+        infile,tempdir,keepbroken=False,verbose=0,stats=None,pagefilter=None
+        ,listing=None):
+    if verbose>1:
+        print ("** bsdtar {0}".format(infile))
+    subcom=["bsdtar","-x","-f",infile,"-C",tempdir]
+    names=None
+    if pagefilter:
+        names=listbsdtar(infile,verbose,stats)
+    return(extractlisted(infile,tempdir,subcom
+        ,lambda listfile: subcom+["-T",listfile]
+        ,names,keepbroken,verbose,stats,pagefilter))
+
+# In-memory extractors. memory(infile,ws,verbose,stats,pagefilter,listing)
+# reads the pages pagefilter keeps into MemoryWorkspace ws, reserving their
+# size first. Returns True, or None if the archive is too big for ws or
+# can't be read this way (it is then extracted to the temp folder instead)
+
+def memoryzipfile(
+        infile,ws,verbose=0,stats=None,pagefilter=None,listing=None):
+    if verbose>1:
+        print ("** Unzipping to memory {0}".format(infile))
+    try:
+        with zipfile.ZipFile(infile,mode='r') as myzip:
+            # Names as ZipFile.extract() would give them, later duplicates
+            # overwrite earlier ones
+            members={}
+            for zi in myzip.infolist():
+                name=zipsafename(zi.filename)
+                if zi.is_dir() or name=='':
+                    continue
+                if pagecount(name.split('/')[-1],pagefilter,verbose,stats):
+                    continue
+                members[name]=zi
+            if not ws.reserve(sum(x.file_size for x in members.values())):
+                return(None)
+            for (name,zi) in members.items():
+                ws.add(name,myzip.read(zi))
+    except:
+        if verbose>1:
+            print("** Zipfile memory read error: {0} - {1}"
+                .format(infile,sys.exc_info()[0]))
+        return(None)
+    return(True)
+
+def memorytarfile(
+        infile,ws,verbose=0,stats=None,pagefilter=None,listing=None):
+    if verbose>1:
+        print ("** Untarring to memory {0}".format(infile))
+    try:
+        with tarfile.open(infile,mode='r') as mytar:
+            members={}
+            for ti in mytar.getmembers():
+                name=zipsafename(ti.name)
+                if name=='' or not ti.isfile():
+                    continue
+                if pagecount(name.split('/')[-1],pagefilter,verbose,stats):
+                    continue
+                members[name]=ti
+            if not ws.reserve(sum(x.size for x in members.values())):
+                return(None)
+            for (name,ti) in members.items():
+                with mytar.extractfile(ti) as fin:
+                    ws.add(name,fin.read())
+    except:
+        if verbose>1:
+            print("** Tar memory read error: {0} - {1}"
+                .format(infile,sys.exc_info()[0]))
+        return(None)
+    return(True)
+
+def memoryunrar(
+        infile,ws,verbose=0,stats=None,pagefilter=None,listing=None):
+    # One "unrar p" writes every file in archive order, as in
+    # cbr2cbzrarstream()
+    if listing is None:
+        listing=rarlist(infile,verbose,stats)
+    if not listing:
+        return(None)
+    last={}
+    for (i,member) in enumerate(listing):
+        if member["type"]=="Directory":
+            continue
+        if member["type"]!="File" or member["size"] is None:
+            return(None)
+        name=zipsafename(member["name"])
+        if name=='':
+            continue
+        if pagecount(name.split('/')[-1],pagefilter,verbose,stats):
+            continue
+        last[name]=i
+    if not ws.reserve(sum(listing[i]["size"] for i in last.values())):
+        return(None)
+    if verbose>1:
+        print ("** unrar to memory {0}".format(infile))
+    subcom=["unrar","p","-inul","-p-","--",infile]
+    proc=None
+    try:
+        statsadd(stats,"subprocesses")
+        proc=subprocess.Popen(subcom,stdout=subprocess.PIPE
+            ,stderr=subprocess.DEVNULL)
+        for (i,member) in enumerate(listing):
+            if member["type"]!="File":
+                continue
+            name=zipsafename(member["name"])
+            if last.get(name)!=i:
+                copybytes(proc.stdout,None,member["size"])
                 continue
+            buf=io.BytesIO()
+            copybytes(proc.stdout,buf,member["size"])
+            data=buf.getvalue()
+            if member["crc"] is not None and (
+                    binascii.crc32(data)!=member["crc"]):
+                raise zipfile.BadZipFile("CRC mismatch: {0}".format(name))
+            ws.add(name,data,member["date_time"])
+        if proc.stdout.read(1):
+            raise zipfile.BadZipFile("More data than listed")
+        proc.stdout.close()
+        if proc.wait()!=0:
+            raise subprocess.CalledProcessError(proc.returncode,subcom)
+    except:
+        if verbose>1:
+            print("** unrar memory read error: {0} - {1}"
+                .format(infile,sys.exc_info()[0]))
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+        return(None)
+    return(True)
+
+extractors = {
+    "zipfile": {
+        "extract": extractzipfile, "memory": memoryzipfile, "command": None},
+    "tarfile": {
+        "extract": extracttarfile, "memory": memorytarfile, "command": None},
+    "unrar": {
+        "extract": extractunrar, "memory": memoryunrar, "command": ["unrar"]},
+    "7z": {"extract": extract7z, "memory": None, "command": ["7z","7zz"]},
+    "bsdtar": {"extract": extractbsdtar, "memory": None, "command": ["bsdtar"]},
+    }
+
+# Extractors to try per archive format, in order of preference. Changed with
+# --extractor (eg. --extractor rar=7z,unrar)
+extractorprefs = {
+    "zip": ["zipfile","7z","bsdtar"],
+    "rar": ["unrar","7z","bsdtar"],
+    "7z": ["7z","bsdtar"],
+    "tar": ["tarfile","bsdtar","7z"],
+    }
+
+# Cache of extractor command lookups
+extractorcommands = {}
+
+def extractorcommand(name):
+    # Path of the program extractor name needs, '' if not installed and
+    # None if it doesn't need one
+    if name not in extractorcommands:
+        extractorcommands[name]=None
+        if extractors[name]["command"]:
+            extractorcommands[name]=''
+            for command in extractors[name]["command"]:
+                if shutil.which(command):
+                    extractorcommands[name]=shutil.which(command)
+                    break
+    return(extractorcommands[name])
+
+def extractorlist(fmt,prefs=None):
+    # Installed extractors for archive format fmt, in order of preference.
+    # prefs defaults to the extractorprefs global
+    if prefs is None:
+        prefs=extractorprefs
+    return([x for x in prefs[fmt] if extractorcommand(x)!=''])
+
+def archiveformat(infile):
+    # Sniff the archive format from its magic bytes: "zip", "rar", "7z"
+    # or "tar". Anything unrecognised is assumed to be RAR, as before
+    try:
+        with open(infile,'rb') as f:
+            head=f.read(512)
+    except OSError:
+        return("rar")
+    if head[:4] in (b'PK\x03\x04',b'PK\x05\x06',b'PK\x07\x08'):
+        return("zip")
+    if head[:7]==b'Rar!\x1a\x07\x00' or head[:8]==b'Rar!\x1a\x07\x01\x00':
+        # RAR4 or RAR5 - unrar older than 5.0 fails on RAR5 and the next
+        # preferred extractor gets a go
+        return("rar")
+    if head[:6]==b'7z\xbc\xaf\x27\x1c':
+        return("7z")
+    if head[257:262]==b'ustar':
+        return("tar")
+    # Self extracting or otherwise prefixed zip
+    if zipfile.is_zipfile(infile):
+        return("zip")
+    return("rar")
+
+# Function that takes input and output file names and converts from
+# CBR to CBZ
+# Returns True if managed to create .CBZ, raises ConversionError on error
+def cbr2cbzconvert(
+        infile, outfile,verbose=0,keepbroken=False
+        ,matchpagelist=[],excludepagelist=[]
+        ,shrink=False,shrinkKB=300,shrinkGray=False,shrinkQual=40
+        ,shrinkHeight=1500,whatif=False,tempdir=None,shrinkjobs=1
+        ,pagecache=None,stats=None,backend=None,exprefs=None,inmemory=0
+        ,temproots=None,target=0,targetper="archive",shrinkformat="jpeg"
+        ,shrinkcompare=False,optimize=False,shrinkAutoGray=False
+        ,hashpages=False,dhash=False,excludehashes=None,scanonly=False):
+    # tempdir is the workspace folder, by default one chosen from temproots
+    # (default cbr2cbztemproots) for the archive's size. Each concurrent
+    # conversion must be given its own tempdir (the chosen ones are per
+    # process and thread). backend (imagebackends key) and exprefs (as
+    # extractorprefs) default to the globals. Archives of up to inmemory
+    # bytes (uncompressed) may be converted in memory. With shrink, target
+    # (bytes) and targetper set a size budget and shrinkformat and
+    # shrinkcompare the output format and shrinkAutoGray grays pages that
+    # look gray (see cbr2cbzbuild()). optimize
+    # optimises the pages losslessly, plain re-zips included. hashpages,
+    # dhash and excludehashes work with page content hashes, scanonly
+    # only hashes the pages and writes nothing (see cbr2cbzbuild())
+    if temproots is None:
+        temproots=cbr2cbztemproots
+    # stats, if given a dict, is filled in with statskeys and the
+    # format and method used, and with shrink shrink_format and
+    # page_quality (quality of each shrunk page by name)
+    if stats is not None:
+        stats.update({x:0 for x in statskeys})
+    # Page filters may be given as lists of rules
+    matchpagelist=patternset(matchpagelist)
+    excludepagelist=patternset(excludepagelist)
+
+    if not os.path.isfile(infile):
+        raise SourceError("infile doesn't exist: {0}".format(infile)
+            ,infile,outfile)
+
+    if not scanonly and os.path.exists(outfile):
+        # This shouldn't happen, test is done in main().
+        # Leave old check here anyway
+        raise OutputExistsError("{0} exists.".format(outfile),infile,outfile)
+
+    # Output folder should exist (created in main()) but leave check
+    # here anyway
+    if not scanonly and not os.path.isdir(os.path.dirname(outfile)):
+        os.makedirs(os.path.dirname(outfile))
+
+    # Page content needs every page in a workspace, so no streaming
+    contentpass=hashpages or excludehashes or scanonly
+
+    fmt=archiveformat(infile)
+    if verbose>1:
+        print ("** Format {0}: {1}".format(fmt,infile))
+    if stats is not None:
+        stats["format"]=fmt
+        stats["bytes_in"]=os.stat(infile).st_size
+
+    # Plain re-zip of a zip needs no temp folder at all
+    if not shrink and not contentpass and fmt=="zip" and extractorlist(fmt,exprefs)[:1]==[
+            "zipfile"]:
+        if stats is not None:
+            stats["method"]="zipstream"
+        with stageslot("zip",stats):
+            result=cbr2cbzzipstream(
+                infile,outfile,verbose=verbose
+                ,matchpagelist=matchpagelist,excludepagelist=excludepagelist
+                ,stats=stats,optimize=optimize,jobs=shrinkjobs)
+        if result and stats is not None:
+            stats["bytes_out"]=os.stat(outfile).st_size
+        return(result)
+
+    # Everything else may need a workspace folder. It is only created once
+    # needed and discarded (in the background) once done with
+    # A RAR that needs listing - for its size, to stream it, to read it
+    # into memory or to filter its pages - is listed once, here
+    listing=None
+    sizing=tempdir is None and len(temproots)>1
+    if fmt=="rar" and "unrar" in extractorlist(fmt,exprefs) and (
+            sizing or extractorlist(fmt,exprefs)[0]=="unrar" and (
+            rarstreamable(fmt,exprefs,shrink,optimize,contentpass)
+            or inmemory>0 or matchpagelist or excludepagelist)):
+        stagestart=time.perf_counter()
+        listing=rarlist(infile,verbose,stats)
+        statsadd(stats,"extract_seconds",time.perf_counter()-stagestart)
+    if tempdir is None:
+        needed=None
+        if sizing:
+            needed=archivesize(infile,fmt,exprefs,verbose,stats,listing)
+        tempdir=tempchoose(temproots,needed,verbose)
+    try:
+        return(cbr2cbzunpack(
+            infile,outfile,fmt,tempdir,verbose=verbose,keepbroken=keepbroken
+            ,matchpagelist=matchpagelist,excludepagelist=excludepagelist
+            ,shrink=shrink,shrinkKB=shrinkKB,shrinkGray=shrinkGray
+            ,shrinkQual=shrinkQual,shrinkHeight=shrinkHeight
+            ,shrinkjobs=shrinkjobs,pagecache=pagecache,stats=stats
+            ,backend=backend,exprefs=exprefs,inmemory=inmemory
+            ,target=target,targetper=targetper,shrinkformat=shrinkformat
+            ,shrinkcompare=shrinkcompare,optimize=optimize
+            ,shrinkAutoGray=shrinkAutoGray,hashpages=hashpages,dhash=dhash
+            ,excludehashes=excludehashes,scanonly=scanonly,listing=listing))
+    finally:
+        tempdiscard(tempdir)
+
+# Uncompressed size of an archive from its listing, for picking a temp
+# folder with room for it. Falls back to the archive's own size
+def archivesize(infile,fmt,exprefs=None,verbose=0,stats=None,listing=None):
+    # listing, if given, is the RAR's rarlist()
+    size=None
+    try:
+        if fmt=="zip":
+            with zipfile.ZipFile(infile) as inzip:
+                size=sum(x.file_size for x in inzip.infolist())
+        elif fmt=="tar":
+            with tarfile.open(infile) as intar:
+                size=sum(x.size for x in intar.getmembers())
+        elif fmt=="rar" and "unrar" in extractorlist(fmt,exprefs):
+            members=listing or rarlist(infile,verbose,stats)
+            if members:
+                size=sum(x["size"] or 0 for x in members)
+    except Exception:
+        size=None
+    if size is None:
+        size=os.stat(infile).st_size
+    return(size)
+
+def rarstreamable(fmt,exprefs,shrink,optimize,contentpass):
+    # True if cbr2cbzunpack() will try streaming the archive through unrar
+    return(not shrink and not optimize and not contentpass and fmt=="rar"
+        and extractorlist(fmt,exprefs)[:1]==["unrar"])
+
+# Middle of cbr2cbzconvert(): get the pages of infile (format fmt) into a
+# workspace - memory, or extracted into the workspace folder tempdir - and
+# hand them to cbr2cbzbuild(). Plain RAR conversions stream instead
+def cbr2cbzunpack(
+        infile,outfile,fmt,tempdir,verbose=0,keepbroken=False
+        ,matchpagelist=[],excludepagelist=[]
+        ,shrink=False,shrinkKB=300,shrinkGray=False,shrinkQual=40
+        ,shrinkHeight=1500,shrinkjobs=1,pagecache=None,stats=None
+        ,backend=None,exprefs=None,inmemory=0,target=0,targetper="archive"
+        ,shrinkformat="jpeg",shrinkcompare=False,optimize=False
+        ,shrinkAutoGray=False,hashpages=False,dhash=False,excludehashes=None
+        ,scanonly=False,listing=None):
+    # Plain conversion of a RAR streams through unrar if it can. listing
+    # is its rarlist() if already made
+    if rarstreamable(fmt,exprefs,shrink,optimize
+            ,hashpages or excludehashes or scanonly):
+        tempprepare(tempdir,verbose)
+        if stats is not None:
+            stats["method"]="rarstream"
+        # Streams extract and zip at once, so take a zip stage slot
+        with stageslot("zip",stats):
+            result=cbr2cbzrarstream(
+                infile,outfile,tempdir,verbose=verbose
+                ,matchpagelist=matchpagelist,excludepagelist=excludepagelist
+                ,stats=stats,listing=listing)
+        if result and stats is not None:
+            stats["bytes_out"]=os.stat(outfile).st_size
+        if result is not None:
+            return(result)
+
+    # Extraction waits for a slot of the extract stage (--pipeline)
+    with stageslot("extract",stats):
+        (ws,brokenflag)=cbr2cbzextract(
+            infile,outfile,fmt,tempdir,verbose=verbose,keepbroken=keepbroken
+            ,matchpagelist=matchpagelist,excludepagelist=excludepagelist
+            ,shrink=shrink,stats=stats,backend=backend,exprefs=exprefs
+            ,inmemory=inmemory,listing=listing)
+
+    try:
+        return(cbr2cbzbuild(
+            ws,infile,outfile,brokenflag,verbose=verbose
+            ,matchpagelist=matchpagelist,excludepagelist=excludepagelist
+            ,shrink=shrink,shrinkKB=shrinkKB,shrinkGray=shrinkGray
+            ,shrinkQual=shrinkQual,shrinkHeight=shrinkHeight
+            ,shrinkjobs=shrinkjobs,pagecache=pagecache,stats=stats
+            ,backend=backend,target=target,targetper=targetper
+            ,shrinkformat=shrinkformat,shrinkcompare=shrinkcompare
+            ,optimize=optimize,shrinkAutoGray=shrinkAutoGray
+            ,hashpages=hashpages,dhash=dhash,excludehashes=excludehashes
+            ,scanonly=scanonly))
+    finally:
+        ws.close()
+
+# Extract stage of cbr2cbzunpack(): returns (ws,brokenflag), the workspace
+# holding the pages and whether the archive only partly extracted
+def cbr2cbzextract(
+        infile,outfile,fmt,tempdir,verbose=0,keepbroken=False
+        ,matchpagelist=[],excludepagelist=[],shrink=False,stats=None
+        ,backend=None,exprefs=None,inmemory=0,listing=None):
+    # Page filters are applied to the archive listing where the extractor
+    # can, excluded pages are then never extracted
+    pagefilter=None
+    if matchpagelist or excludepagelist:
+        def pagefilter(leaf):
+            return(pageexcluded(leaf,matchpagelist,excludepagelist))
+    if not extractorlist(fmt,exprefs):
+        raise ExtractError("No extractor installed for {0}: {1}".format(
+            fmt,infile),infile,outfile)
+
+    # Small archives are read into memory if the preferred extractor can
+    # and (with --shrink) the image backend works on file objects
+    stagestart=time.perf_counter()
+    ws=None
+    memory=extractors[extractorlist(fmt,exprefs)[0]]["memory"]
+    if inmemory>0 and memory and (
+            not shrink or imagebackends[imagebackend(backend)]["inmemory"]):
+        ws=MemoryWorkspace(inmemory,memorybudget)
+        if stats is not None:
+            counted=(stats["pages"],stats["pages_excluded"])
+        if memory(infile,ws,verbose,stats,pagefilter,listing):
+            if stats is not None:
+                stats["method"]="memory"
+                statspeak(stats,"memory_peak_bytes",ws.reserved)
+        else:
+            ws.close()
+            ws=None
+            if stats is not None:
+                (stats["pages"],stats["pages_excluded"])=counted
+
+    brokenflag=False # Flag for error on extract (for --keepbroken)
+    if ws is None:
+        # No os.chdir() into the temp folder - it is process wide.
+        # Extraction targets tempdir explicitly and zip file paths are made
+        # relative to it
+
+        # Try the extractors for the format in order of preference, each in
+        # an empty workspace folder (a failed attempt's is discarded)
+        if stats is not None:
+            stats["method"]="extract"
+        extracted=False
+        for name in extractorlist(fmt,exprefs):
+            if stats is not None:
+                counted=(stats["pages"],stats["pages_excluded"])
+            tempprepare(tempdir,verbose)
+            result=extractors[name]["extract"](
+                infile,tempdir,keepbroken,verbose,stats,pagefilter,listing)
+            if result=="broken":
+                brokenflag=True
+                print("* KEEPBROKEN: Continue to zip content {0}".format(
+                    infile))
+            if result:
+                extracted=True
+                break
+            if stats is not None:
+                (stats["pages"],stats["pages_excluded"])=counted
+        if not extracted:
+            statsadd(stats,"extract_seconds",time.perf_counter()-stagestart)
+            raise ExtractError("Could not extract {0}".format(infile)
+                ,infile,outfile)
+        if stats is not None:
+            statspeak(stats,"temp_peak_bytes",treesize(tempdir))
+        ws=DiskWorkspace(tempdir)
+    statsadd(stats,"extract_seconds",time.perf_counter()-stagestart)
+    return((ws,brokenflag))
+
+# Second half of cbr2cbzconvert(): exclude, shrink and zip the pages of
+# workspace ws into outfile. brokenflag is set if the archive only partly
+# extracted (--keepbroken)
+def cbr2cbzbuild(
+        ws,infile,outfile,brokenflag=False,verbose=0
+        ,matchpagelist=[],excludepagelist=[]
+        ,shrink=False,shrinkKB=300,shrinkGray=False,shrinkQual=40
+        ,shrinkHeight=1500,shrinkjobs=1,pagecache=None,stats=None
+        ,backend=None,target=0,targetper="archive",shrinkformat="jpeg"
+        ,shrinkcompare=False,optimize=False,shrinkAutoGray=False
+        ,hashpages=False,dhash=False,excludehashes=None,scanonly=False
+        ):
+    # With target (bytes) pages are shrunk at the highest quality that
+    # fits the archive (targetper "archive") or each page ("page") in it.
+    # Pages are shrunk to shrinkformat (a shrinkformats key), with
+    # shrinkcompare also to JPEG for the shrink_jpeg_bytes stat. With
+    # shrinkAutoGray pages that look gray are grayed. With optimize all
+    # pages are then optimised losslessly. With hashpages stats gets
+    # page_hashes, (name,sha256,dHash,size) of each page (dHash with
+    # dhash), excludehashes is a set of hashes of pages to exclude and
+    # scanonly stops there
+    # Each half waits for a slot of its stage (--pipeline)
+    with stageslot("shrink",stats):
+        cbr2cbzpages(
+            ws,infile,outfile,verbose=verbose
+            ,matchpagelist=matchpagelist,excludepagelist=excludepagelist
+            ,shrink=shrink,shrinkKB=shrinkKB,shrinkGray=shrinkGray
+            ,shrinkQual=shrinkQual,shrinkHeight=shrinkHeight
+            ,shrinkjobs=shrinkjobs,pagecache=pagecache,stats=stats
+            ,backend=backend,target=target,targetper=targetper
+            ,shrinkformat=shrinkformat,shrinkcompare=shrinkcompare
+            ,optimize=optimize,shrinkAutoGray=shrinkAutoGray
+            ,hashpages=hashpages,dhash=dhash,excludehashes=excludehashes
+            ,scanonly=scanonly)
+    if scanonly:
+        return(True)
+    with stageslot("zip",stats):
+        return(cbr2cbzzip(ws,infile,outfile,brokenflag,verbose,stats))
+
+# Shrink stage of cbr2cbzbuild(): exclude, shrink and optimise the pages of
+# workspace ws
+def cbr2cbzpages(
+        ws,infile,outfile,verbose=0
+        ,matchpagelist=[],excludepagelist=[]
+        ,shrink=False,shrinkKB=300,shrinkGray=False,shrinkQual=40
+        ,shrinkHeight=1500,shrinkjobs=1,pagecache=None,stats=None
+        ,backend=None,target=0,targetper="archive",shrinkformat="jpeg"
+        ,shrinkcompare=False,optimize=False,shrinkAutoGray=False
+        ,hashpages=False,dhash=False,excludehashes=None,scanonly=False
+        ):
+    # Check what files need to be excluded (pages the extractor couldn't
+    # leave out)
+    stagestart=time.perf_counter()
+    names=[]
+    for name in ws.names():
+        leaf=name.split('/')[-1]
+        statsadd(stats,"pages")
+        if pageexcluded(leaf,matchpagelist,excludepagelist):
+            if verbose>2:
+                print("*** Excluding page: {0}".format(leaf))
+            ws.remove(name)
+            statsadd(stats,"pages_excluded")
+            continue
+        names.append(name)
+
+    # Then by content
+    if hashpages or excludehashes:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1,shrinkjobs)) as hashpool:
+            hashes=list(hashpool.map(
+                lambda name: pagehash(ws,name,dhash),names))
+        pagehashes=[]
+        for (name,(sha,dh)) in zip(names,hashes):
+            pagehashes.append((name,sha,dh,ws.size(name)))
+            if excludehashes and (sha in excludehashes
+                    or dh in excludehashes):
+                if verbose>2:
+                    print("*** Excluding page by content: {0}".format(name))
+                ws.remove(name)
+                statsadd(stats,"pages_excluded")
+                statsadd(stats,"pages_excluded_hash")
+        if hashpages and stats is not None:
+            stats["page_hashes"]=pagehashes
+    statsadd(stats,"exclude_seconds",time.perf_counter()-stagestart)
+    if scanonly:
+        return
 
     # Shrink archive
     if shrink:
+        backend=imagebackends[imagebackend(backend)]
+        shrinkext=shrinkformats[shrinkformat]["ext"]
         if verbose>1:
             print("** Shrinking {0}".format(infile))
-        # Walk through the extracted files
-        for root,dirs,files in os.walk(cbr2cbztemp):
-            dirs.sort()
-            files.sort()
-            for leaf in files:
+        if stats is not None:
+            stats["shrink_format"]=shrinkformat
+
+        # Pages are converted by a pool of threads (the work happens in
+        # subprocesses or in Pillow which release the GIL). Planning which
+        # pages to shrink stays sequential so the name clash check gives
+        # the same answer whatever order the pool finishes in
+        if shrinkjobs<1:
+            shrinkjobs=1
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=shrinkjobs) as shrinkpool:
+            stagestart=time.perf_counter()
+            grays={}
+            if shrinkAutoGray and not shrinkGray:
+                names=ws.names()
+                grays=dict(zip(names,shrinkpool.map(
+                    lambda name: pagegray(ws,name),names)))
+            shrinkplan=[]
+            claimed=set() # Names pages will be renamed to
+            for name in ws.names():
+                leaf=name.split('/')[-1]
                 if verbose>3:
                     print ("*** Assessing {0}".format(leaf.encode(
                         'ascii', 'replace').decode('ascii', 'replace')))
-                shrinkfile=os.path.join(root,leaf)
-                # Use Imagemagick identify to get size, extension, type, width
-                # and height
-                if imversion == 7:
-                    # IM7 ?
-                    subcom=["magick","identify", "-precision", "16", "-format"
-                            , '%b %e %m %W %H', "-quiet", shrinkfile]
-                else:
-                    # Ubuntu IM6
-                    subcom=["identify", "-precision", "16", "-format"
-                            , '%b %e %m %W %H', "-quiet", shrinkfile]
-                if verbose>4:
-                    print ("***** {0}".format(subcom))
+                # Get type, width and height from the file header
                 try:
-                    output=subprocess.check_output(subcom)
-                except subprocess.CalledProcessError as e:
-                    output=e.output
+                    with ws.open(name) as fin:
+                        imginfo=imageprobe(fin)
+                except OSError:
+                    imginfo=None
+                if imginfo is None:
                     if verbose>3:
-                        print(
-                            "**** ERROR: CalledProcessError: identify {0}"
-                            .format(leaf)
-                            )
-                        try:
-                            output=output.decode("UTF-8","ignore")
-                            print ("**** {0}".format(output))
-                        except:
-                            print(format(sys.exc_info()[0]))
-                    continue
-                except:
-                    if verbose>3:
-                        print(
-                            "**** ERROR: Could not get image information on {0}"
-                            .format(leaf)
-                            )
-                    continue
-
-                # Extract image stats
-                try:
-                    output=output.decode("UTF-8","ignore")
-                    (imgsize,imgext,imgtype,imgx,imgy)=output.split(" ")
-                    # Bug in identify-im6 (on Ubuntu 18.04) not respecting precision?
-                    #imgsize=int(imgsize.replace("B",""))
-                    imgsize=os.stat(shrinkfile).st_size
-                    imgx=int(imgx)
-                    imgy=int(imgy)
-                    # imgar is the aspect ratio
-                    imgar=imgx/imgy
-                    if verbose>4:
-                        print("***** Imagestats:",imgsize,imgext,imgtype
-                              ,imgx,imgy,imgar)
-                except:
-                    if verbose>3:
-                        print("**** Output: {0}".format(output))
-                        print(format(sys.exc_info()[0]))
-                        print("**** ERROR: Could not extract image sizes")
+                        print("**** Not a known image type: {0}".format(
+                            leaf.encode('ascii', 'replace').decode(
+                            'ascii', 'replace')))
+                    statsadd(stats,"pages_skipped")
                     continue
+                (imgtype,imgx,imgy)=imginfo
+                imgext=os.path.splitext(leaf)[1][1:]
+                imgsize=ws.size(name)
+                # imgar is the aspect ratio
+                imgar=imgx/imgy
+                if verbose>4:
+                    print("***** Imagestats:",imgsize,imgext,imgtype
+                          ,imgx,imgy,imgar)
 
                 # Only process understood file types
                 if not (imgtype=='JPEG' or imgtype=='PNG'):
+                    statsadd(stats,"pages_skipped")
                     continue
 
+                if imgext=="":
+                    newname=name+shrinkext
+                else:
+                    newname=re.sub(r"\."+re.escape(imgext)+"$"
+                                   ,lambda m: shrinkext,name)
+
                 # Check for a name clash
                 # This would happen with archive files which only differ by extension
                 # eg. file1.png, file1.jpg - when file1.png is shrunk
-                if imgext!='jpg' and os.path.exists(shrinkfile.replace(imgext
-                                                    ,"jpg")):
+                # or file1.png, file1.jpeg - when both are shrunk
+                # (to JPEG, likewise file1.webp with --shrink-format webp)
+                if newname!=name and (
+                        ws.exists(newname) or newname in claimed):
                     # Don't attempt shrinking this file as we can't
                     #rename it
                     if verbose>0:
                         print("* WARNING: Shrink filename clash: {0} -> {1}"
-                              ,shrinkfile, leaf.replace(imgext,"jpg"))
+                              .format(name, newname))
+                    statsadd(stats,"pages_skipped")
                     continue
 
                 # We expect wider pages to be larger so our allowance is
@@ -281,131 +2676,58 @@ def cbr2cbz(
                 # If a page is less than shrinklimit skip shrink attempt (to
                 # save time and image quality)
                 shrinklimit=(imgar*1.5*shrinkKB*1000)
-                if imgsize>shrinklimit or shrinkGray:
-                    if shrinkGray:
-                        if imversion == 7:
-                            # IM7 ?
-                            subcom=[
-                                "magick","convert",shrinkfile,"-quality"
-                                , str(shrinkQual),"-grayscale","Rec601Luma"
-                                , "-resize", "x"+str(shrinkHeight)+">"
-                                ,shrinkfile+".shrink.jpg"
-                                ]
-                        else:
-                            # Ubuntu IM6
-                            subcom=[
-                                "convert",shrinkfile,"-quality"
-                                , str(shrinkQual),"-grayscale","Rec601Luma"
-                                , "-resize", "x"+str(shrinkHeight)+">"
-                                ,shrinkfile+".shrink.jpg"
-                                ]
-                    else:
-                        if imversion == 7:
-                            # IM7?
-                            subcom=[
-                                "magick","convert",shrinkfile,"-quality"
-                                ,str(shrinkQual), "-resize"
-                                ,"x"+str(shrinkHeight)+">"
-                                ,shrinkfile+".shrink.jpg"
-                                ]
-                        else:
-                            # Ubuntu IM6
-                            subcom=[
-                                "convert",shrinkfile,"-quality"
-                                ,str(shrinkQual), "-resize"
-                                ,"x"+str(shrinkHeight)+">"
-                                ,shrinkfile+".shrink.jpg"
-                                ]
-                    if verbose>4:
-                        print ("***** {0}".format(subcom))
-                    try:
-                        # Call convert
-                        output=subprocess.check_output(subcom)
-                    except subprocess.CalledProcessError as e:
-                        output=e.output
-                        if verbose>4:
-                            print(
-                                "***** ERROR: CalledProcessError: convert {0}"
-                                .format(shrinkfile)
-                                )
-                            try:
-                                output=output.decode("UTF-8","ignore")
-                            except:
-                                print(format(sys.exc_info()[0]))
-                            print ("* {0}".format(output))
-                        if os.path.exists(shrinkfile+".shrink.jpg"):
-                            try:
-                                os.unlink(shrinkfile+".shrink.jpg")
-                                continue
-                            except:
-                                if verbose>0:
-                                    print(
-                                        "* Could not clean up shrink file {0}"
-                                        .format(shrinkfile+".shrink.jpg")
-                                        )
-                                return(False)
-                    except:
-                        if verbose>4:
-                            print(format(sys.exc_info()[0]))
-                            print("ERROR: Could not convert file {0}"
-                                .format(shrinkfile))
-                        if os.path.exists(shrinkfile+".shrink.jpg"):
-                            try:
-                                os.unlink(shrinkfile+".shrink.jpg")
-                                continue
-                            except:
-                                if verbose>0:
-                                    print(
-                                        "* Could not clean up shrink file {0}"
-                                        .format(shrinkfile+".shrink.jpg")
-                                        )
-                                return(False)
-
-                    # Do a check the new file is smaller before replacing
-                    oldsize=os.stat(shrinkfile).st_size
-                    newsize=os.stat(shrinkfile+".shrink.jpg").st_size
-                    if (oldsize*0.9)>newsize or shrinkGray:
-                        os.unlink(shrinkfile) # Not necessary on POSIX
-                        if imgext=="":
-                            newname=shrinkfile+".jpg"
-                        else:
-                            newname=re.sub(r"\."+re.escape(imgext)+"$",".jpg"
-                                           ,shrinkfile)
-                        os.rename(shrinkfile+".shrink.jpg",newname)
-                        if verbose>2:
-                            print(
-                                "*** Shrank    {3} {1}/{2} : {0}"
-                                .format(leaf.encode('ascii', 'replace'
-                                ).decode('ascii', 'replace')
-                                , newsize, oldsize
-                                , round(newsize/oldsize,2))
-                                )
-                    else:
-                        if verbose>2:
-                            print(
-                                "*** No shrink {3} {1}/{2} : {0}"
-                                .format(leaf.encode('ascii', 'replace'
-                                ).decode('ascii', 'replace')
-                                , newsize, oldsize
-                                , round(newsize/oldsize,2))
-                                )
-                        os.unlink(shrinkfile+".shrink.jpg")
-
-    # Collate a list of all files and force sort order into zip
-    zipfiles=[] #os.listdir(cbr2cbztemp)
-    for root,dirs,files in os.walk(cbr2cbztemp):
-        dirs.sort()
-        files.sort()
-        if verbose>2:
-            print("*** Adding zip directory : {0} - files:{1} "
-                .format(root,len(files)))
-        for leaf in files:
-            addfile=os.path.join(root,leaf)
-            zipfiles.append(addfile.replace(cbr2cbztemp+'/',''))
-            if verbose>3:
-                print("**** Adding zip list file : {0}".format(
-                    leaf.encode('ascii', 'replace').decode('ascii', 'replace')))
-    zipfiles.sort() # To be sure, test
+                if target:
+                    # The byte budget decides instead
+                    shrinklimit=target if targetper=="page" else -1
+                # Pages found to be gray (--shrinkAutoGray) are grayed
+                # whatever their size
+                gray=shrinkGray or grays.get(name,False)
+                if gray and not shrinkGray:
+                    statsadd(stats,"pages_autogray")
+                if imgsize>shrinklimit or gray:
+                    claimed.add(newname)
+                    shrinkplan.append((name,newname,gray))
+                else:
+                    statsadd(stats,"pages_skipped")
+            statsadd(stats,"identify_seconds",time.perf_counter()-stagestart)
+
+            def convert(plan):
+                (name,newname,gray)=plan
+                shrinkpage(
+                    ws,name,newname,backend,shrinkQual
+                    ,shrinkHeight,shrinkGray,verbose,pagecache,stats
+                    ,target if target and targetper=="page" else None
+                    ,shrinkformat,shrinkcompare,gray)
+
+            stagestart=time.perf_counter()
+            try:
+                if target and targetper=="archive":
+                    shrinkarchive(
+                        ws,shrinkplan,backend,target,shrinkHeight
+                        ,shrinkGray,verbose,pagecache,stats,shrinkpool
+                        ,shrinkformat,shrinkcompare)
+                else:
+                    list(shrinkpool.map(convert,shrinkplan))
+            except ShrinkError as e:
+                raise ShrinkError("Could not replace shrunk pages of {0}: {1}"
+                    .format(infile,e),infile,outfile)
+            statsadd(stats,"convert_seconds",time.perf_counter()-stagestart)
+
+    # Lossless optimisation, of shrunk pages too
+    if optimize:
+        stagestart=time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1,shrinkjobs)) as optimizepool:
+            list(optimizepool.map(
+                lambda name: optimizepage(ws,name,verbose,stats)
+                ,ws.names()))
+        statsadd(stats,"optimize_seconds",time.perf_counter()-stagestart)
+
+# Zip stage of cbr2cbzbuild(): write the pages of workspace ws to outfile
+def cbr2cbzzip(ws,infile,outfile,brokenflag=False,verbose=0,stats=None):
+    # Collate a list of all files, sorted into zip
+    stagestart=time.perf_counter()
+    zipfiles=ws.names()
 
     if brokenflag:
         # Prefix filename with broken-
@@ -414,67 +2736,462 @@ def cbr2cbz(
             , "broken-"+os.path.basename(outfile)
         )
         if os.path.exists(outfile):
-            print("Output file {0} exists".format(outfile))
-            return(False)
+            raise OutputExistsError("Output file {0} exists".format(outfile)
+                ,infile,outfile)
 
     # Compress a new cbz using zipfile
-
-    # For Python < 3.5 use append mode (should be safe), use x mode for >3.5
-    if ((sys.version_info[0]==3) and (sys.version_info[1]<5)):
-        zipmode='a'
-    else:
-        zipmode='x'
-    
-    if verbose>1:
-        print ("** Creating with zipfile: {0}, mode '{1}'".format(outfile,zipmode))
-    try:
-        outzip=zipfile.ZipFile(outfile,mode=zipmode,compression=zipfile.ZIP_STORED,strict_timestamps=False)
-
-    except FileExistsError:
-        # This really shouldn't happen, tested in main() and earlier
-        # in this function
-        print ("ERROR: File exists: {0}".format(outfile))
-        return(False)
-    except NameError as e:
-        print("ERROR: Zipfile creation NameError")
-        print(e)
-        return(False)
-    except:
-        print("ERROR: Zipfile creation error")
-        print(sys.exc_info()[0])
-        return(False)
+    outzip=cbr2cbzzipopen(outfile,verbose)
+    if outzip is None:
+        raise ZipWriteError("Could not create {0}".format(outfile)
+            ,infile,outfile)
 
     for zf in zipfiles:
         # Force filenames to be ascii and add to zip
         try:
-            zfarcname=zf
-            zfarcname=zfarcname.replace(u'\xa0', ' ')
-            zfarcname=(
-                zfarcname.encode('ascii', 'replace').decode('ascii', 'replace')
-                )
-            outzip.write(zf,arcname=zfarcname)
-            #outzip.write(zf)
+            zfarcname=zipasciiname(zf)
+            ws.addtozip(outzip,zf,zfarcname)
             if verbose>2:
                 print(
                     "*** Adding: {0}".format(zf).encode(
                         'ascii', 'replace').decode('ascii', 'replace')
                 )
         except:
-            print(
-                "Error adding file:{0}".format(zf).encode(
-                    'ascii', 'replace').decode('ascii', 'replace')
-            )
-            print(sys.exc_info()[0])
             outzip.close()
             os.remove(outfile)
-            return(False)
+            raise ZipWriteError("Error adding file:{0} {1}".format(
+                zf.encode('ascii', 'replace').decode('ascii', 'replace')
+                ,sys.exc_info()[0]),infile,outfile)
     outzip.close()
+    statsadd(stats,"zip_seconds",time.perf_counter()-stagestart)
+    if stats is not None:
+        stats["bytes_out"]=os.stat(outfile).st_size
     if brokenflag:
         # We've forced zip creation with 
         # --keepbroken. Report as failed for user review
+        raise BrokenArchiveError(
+            "Archive only partly extracted, kept as {0}".format(outfile)
+            ,infile,outfile)
+    return(True)
+
+# Takes the same arguments as cbr2cbzconvert()
+# Returns True if managed to create .CBZ and False on error. Temp folder
+# problems are raised as WorkspaceError, as they affect every conversion
+def cbr2cbz(infile,outfile,verbose=0,**convertargs):
+    try:
+        return(cbr2cbzconvert(infile,outfile,verbose=verbose,**convertargs))
+    except WorkspaceError:
+        raise
+    except OutputExistsError as e:
+        if verbose>0:
+            print("ERROR: {0}".format(e))
+    except BrokenArchiveError:
+        # Already reported by the KEEPBROKEN message
+        pass
+    except ConversionError as e:
+        print("ERROR: {0}".format(e))
+    return(False)
+
+# Library interface. A Converter holds the options (page PatternSets,
+# image backend, extractor preferences, temp folder) for any number of
+# convert() calls, eg.
+#
+#   with cbr2cbz.Converter(excludepages=["Thumbs.db"],shrink=True) as conv:
+#       for (infile,outfile) in work:
+#           try:
+#               stats=conv.convert(infile,outfile)
+#           except cbr2cbz.ConversionError as e:
+#               ...
+#
+# A Converter isn't thread safe, use one per thread. The ImageMagick
+# command format (imversion) and the in-memory budget (memorybudget) stay
+# process wide
+class Converter:
+    def __init__(
+            self,matchpages=[],excludepages=[],casesensitive=False
+            ,keepbroken=False,shrink=False,shrinkKB=300,shrinkGray=False
+            ,shrinkQual=40,shrinkHeight=1500,shrinkjobs=1,imbackend="auto"
+            ,exprefs=None,tempdir=None,pagecache=None,inmemoryMB=64
+            ,targetKB=0,targetper="archive",shrinkformat="jpeg"
+            ,shrinkcompare=False,optimize=False,shrinkAutoGray=False
+            ,hashpages=False,dhash=False,excludehashes=None,verbose=0
+            ):
+        # exprefs maps archive formats to lists of extractor names,
+        # formats not given keep the default preference. tempdir is
+        # created if needed and emptied between archives, by default a new
+        # one is made and removed by close()
+        if imbackend!="auto" and imbackend not in imagebackends:
+            raise ValueError("Unknown image backend {0}".format(imbackend))
+        if imbackend=="pillow" and Image is None:
+            raise ValueError("Image backend pillow requires the Pillow module")
+        self.exprefs=dict(extractorprefs)
+        for (fmt,names) in (exprefs or {}).items():
+            if fmt not in extractorprefs or not names:
+                raise ValueError("Bad extractor preference {0}={1}".format(
+                    fmt,names))
+            for name in names:
+                if name not in extractors:
+                    raise ValueError("Unknown extractor {0}".format(name))
+            self.exprefs[fmt]=list(names)
+        self.backend=imagebackend(imbackend)
+        if shrinkAutoGray and Image is None:
+            raise ValueError("shrinkAutoGray requires the Pillow module")
+        if shrink and shrinkformat not in imagebackends[self.backend][
+                "formats"]():
+            raise ValueError("Image backend {0} can't write {1}".format(
+                self.backend,shrinkformat))
+        self.matchpagelist=PatternSet(matchpages,casesensitive)
+        self.excludepagelist=PatternSet(excludepages,casesensitive)
+        self.convertargs=dict(
+            verbose=verbose,keepbroken=keepbroken,shrink=shrink
+            ,shrinkKB=shrinkKB,shrinkGray=shrinkGray,shrinkQual=shrinkQual
+            ,shrinkHeight=shrinkHeight,shrinkjobs=shrinkjobs
+            ,pagecache=pagecache,inmemory=inmemoryMB*1000000
+            ,target=targetKB*1000,targetper=targetper
+            ,shrinkformat=shrinkformat,shrinkcompare=shrinkcompare
+            ,optimize=optimize,shrinkAutoGray=shrinkAutoGray
+            ,hashpages=hashpages,dhash=dhash
+            ,excludehashes=set(excludehashes or []))
+        self.ownstemp=tempdir is None
+        if tempdir is None:
+            tempdir=tempfile.mkdtemp(prefix="cbr2cbz-")
+        self.tempdir=os.path.abspath(os.path.expanduser(tempdir))
+
+    def convert(self,infile,outfile):
+        # Convert infile to the cbz outfile. Returns the stats dict
+        # (statskeys, format, method and seconds), raises ConversionError
+        stats={}
+        start=time.perf_counter()
+        cbr2cbzconvert(
+            infile,outfile,matchpagelist=self.matchpagelist
+            ,excludepagelist=self.excludepagelist,temproots=[self.tempdir]
+            ,stats=stats,backend=self.backend,exprefs=self.exprefs
+            ,**self.convertargs)
+        stats["seconds"]=time.perf_counter()-start
+        return(stats)
+
+    def close(self):
+        # Empty the temp folder, removing it if the Converter made it
+        tempcleanwait()
+        cbr2cbzclean(create=False,delete=self.ownstemp,tempdir=self.tempdir)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self,*exc):
+        self.close()
         return(False)
-    else:
+
+# Source tree scanning. Works like os.walk() (top down, sorted, symlinked
+# folders listed but not followed) on os.scandir(), handing back DirEntry
+# objects for files so their stat() is made once and cached
+def scandirectory(root):
+    # Returns (dirnames,fileentries,subdirs to descend into) for root
+    dirs=[]
+    files=[]
+    subdirs=[]
+    try:
+        with os.scandir(root) as it:
+            entries=sorted(it,key=lambda x: x.name)
+    except OSError:
+        return(dirs,files,subdirs)
+    for entry in entries:
+        try:
+            isdir=entry.is_dir()
+        except OSError:
+            isdir=False
+        if isdir:
+            dirs.append(entry.name)
+            if not entry.is_symlink():
+                subdirs.append(entry.path)
+        else:
+            files.append(entry)
+    return(dirs,files,subdirs)
+
+def scantree(top,skip=None):
+    # Yields (root,dirnames,fileentries) for top and everything below it.
+    # Folders skip(root) is True for are yielded empty and not descended
+    stack=[top]
+    while stack:
+        root=stack.pop()
+        if skip and skip(root):
+            yield(root,[],[])
+            continue
+        (dirs,files,subdirs)=scandirectory(root)
+        yield(root,dirs,files)
+        stack.extend(reversed(subdirs))
+
+def scansource(top,jobs=1,skip=None):
+    # scantree() with each top level folder scanned by a pool of jobs
+    # threads (network file systems answer several listings at once).
+    # Yields in the same order as scantree()
+    if jobs<=1 or (skip and skip(top)):
+        yield from scantree(top,skip)
+        return
+    (dirs,files,subdirs)=scandirectory(top)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as scanpool:
+        futures=[scanpool.submit(lambda x: list(scantree(x,skip)),x)
+            for x in subdirs]
+        yield(top,dirs,files)
+        for future in futures:
+            yield from future.result()
+
+def destlisting(listings,outdir):
+    # Set of the names in destination folder outdir (None if it doesn't
+    # exist), listed once and then kept up to date by the caller.
+    # listings is the dict of folders listed so far
+    if outdir not in listings:
+        try:
+            with os.scandir(outdir) as it:
+                listings[outdir]={x.name for x in it}
+        except OSError:
+            listings[outdir]=None
+    return(listings[outdir])
+
+# Copying (-c and --noconvert) with --link-mode. Each mode tries its
+# methods in order, the last ones always work: reflink shares the data
+# copy-on-write (Btrfs, XFS), hardlink makes the destination the same file
+# as the source, range copies in the kernel (os.copy_file_range, no data
+# through user space) and buffered is a plain shutil.copyfile(). Only
+# hardlink, asked for explicitly, leaves the destination sharing the source
+# file - changing one changes the other
+linkmodes = {
+    "auto": ["reflink","range","buffered"],
+    "reflink": ["reflink","range","buffered"],
+    "hardlink": ["hardlink","range","buffered"],
+    "copy": ["range","buffered"],
+}
+
+# ioctl number of Linux FICLONE (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+def copyreflink(src,dst):
+    if fcntl is None:
+        return(False)
+    with open(src,'rb') as fin, open(dst,'wb') as fout:
+        fcntl.ioctl(fout.fileno(),FICLONE,fin.fileno())
+    return(True)
+
+def copyhardlink(src,dst):
+    os.link(src,dst)
+    return(True)
+
+def copyrange(src,dst):
+    if not hasattr(os,"copy_file_range"):
+        return(False)
+    with open(src,'rb') as fin, open(dst,'wb') as fout:
+        size=os.fstat(fin.fileno()).st_size
+        copied=0
+        while copied<size:
+            done=os.copy_file_range(fin.fileno(),fout.fileno(),size-copied)
+            if done==0:
+                break
+            copied+=done
+    return(copied==size)
+
+def copybuffered(src,dst):
+    shutil.copyfile(src,dst)
+    return(True)
+
+copymethods = {
+    "reflink": copyreflink,
+    "hardlink": copyhardlink,
+    "range": copyrange,
+    "buffered": copybuffered,
+}
+
+def linkcopy(src,dst,linkmode="auto",verbose=0):
+    # Copy src to dst (which mustn't exist) by the first method of linkmode
+    # that works. Returns the method used
+    for method in linkmodes[linkmode]:
+        try:
+            if copymethods[method](src,dst):
+                return(method)
+        except OSError as e:
+            if method=="buffered":
+                raise
+            if verbose>2:
+                print("*** {0} failed for {1}: {2}".format(method,dst,e))
+        # Remove whatever a failed method left behind
+        if os.path.lexists(dst):
+            os.unlink(dst)
+
+# Conversion index (--incremental). One row per source file recording what
+# it looked like and how its output was made, so later runs only redo
+# sources that changed without checking the destination tree
+indexname = ".cbr2cbz-index.sqlite"
+
+def indexopen(indexfile):
+    db=sqlite3.connect(indexfile)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS sources ("
+        "source TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT,"
+        " options TEXT, outfile TEXT, updated REAL)")
+    return(db)
+
+def filehash(filename):
+    # sha256 of a file's content
+    h=hashlib.sha256()
+    with open(filename,'rb') as f:
+        for buf in iter(lambda: f.read(streambufsize),b''):
+            h.update(buf)
+    return(h.hexdigest())
+
+def indexrecord(db,source,st,optionset,outfile,usehash=False):
+    # Record source (with os.stat() result st) as done. optionset None
+    # means the output was found already made and the options are unknown
+    db.execute(
+        "INSERT OR REPLACE INTO sources VALUES (?,?,?,?,?,?,?)"
+        ,(source,st.st_size,st.st_mtime_ns
+        ,filehash(source) if usehash else None
+        ,optionset,outfile,time.time()))
+
+def indexcompare(db,source,st,optionset,outfile,usehash=False):
+    # Compare source (with os.stat() result st) against its index entry.
+    # Returns None if it has no entry, True if nothing changed and False
+    # if its output should be redone
+    row=db.execute(
+        "SELECT size,mtime,hash,options,outfile FROM sources WHERE source=?"
+        ,(source,)).fetchone()
+    if row is None:
+        return(None)
+    (size,mtime,oldhash,oldoptions,oldoutfile)=row
+    if oldoutfile!=outfile or size!=st.st_size:
+        return(False)
+    if oldoptions is not None and oldoptions!=optionset:
+        return(False)
+    if mtime==st.st_mtime_ns:
         return(True)
+    if usehash and oldhash is not None and oldhash==filehash(source):
+        # Touched but not modified
+        db.execute("UPDATE sources SET mtime=? WHERE source=?"
+            ,(st.st_mtime_ns,source))
+        return(True)
+    return(False)
+
+# Page index (--pageindex). The pages of every converted (or --pagescan)
+# archive by content, so pages repeated across the library (scanner
+# credits, adverts) can be reported and excluded by content
+# (--excludepagehash) whatever they are named
+def pageindexopen(pageindexfile):
+    db=sqlite3.connect(pageindexfile)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS pages ("
+        "archive TEXT, name TEXT, sha256 TEXT, dhash TEXT, size INTEGER,"
+        " PRIMARY KEY (archive,name))")
+    db.execute("CREATE INDEX IF NOT EXISTS pages_sha256 ON pages (sha256)")
+    db.execute("CREATE INDEX IF NOT EXISTS pages_dhash ON pages (dhash)")
+    return(db)
+
+def pageindexrecord(db,archive,hashes):
+    # Replace the pages recorded for archive with hashes, a list of
+    # (name,sha256,dhash,size)
+    db.execute("DELETE FROM pages WHERE archive=?",(archive,))
+    db.executemany("INSERT OR REPLACE INTO pages VALUES (?,?,?,?,?)"
+        ,[(archive,)+tuple(x) for x in hashes])
+
+def pageindexreport(db,reportfile,minarchives=2):
+    # Write the pages found in at least minarchives archives, most
+    # repeated first, and where they are. Lines start with the hash (the
+    # rest are comments) so the report can be given to --excludepagehash
+    # as it is, or after deleting the lines of pages to keep
+    with open(reportfile,"w") as f:
+        f.write("# Identical pages: sha256 archives bytes name\n")
+        for (sha,count,size,name) in db.execute(
+                "SELECT sha256,COUNT(DISTINCT archive),MAX(size),MIN(name)"
+                " FROM pages GROUP BY sha256"
+                " HAVING COUNT(DISTINCT archive)>=?"
+                " ORDER BY 2 DESC,1",(minarchives,)).fetchall():
+            f.write("{0} {1} {2} {3}\n".format(sha,count,size,name))
+            for (archive,name) in db.execute(
+                    "SELECT archive,name FROM pages WHERE sha256=?"
+                    " ORDER BY archive,name",(sha,)):
+                f.write("#   {0}: {1}\n".format(archive,name))
+        f.write("# Similar pages (same dHash, different bytes):"
+            " dhash archives variants name\n")
+        for (dhash,count,variants,name) in db.execute(
+                "SELECT dhash,COUNT(DISTINCT archive),COUNT(DISTINCT sha256)"
+                ",MIN(name) FROM pages WHERE dhash IS NOT NULL"
+                " GROUP BY dhash HAVING COUNT(DISTINCT sha256)>1"
+                " AND COUNT(DISTINCT archive)>=? ORDER BY 2 DESC,1"
+                ,(minarchives,)).fetchall():
+            f.write("{0} {1} {2} {3}\n".format(dhash,count,variants,name))
+            for (archive,name) in db.execute(
+                    "SELECT archive,name FROM pages WHERE dhash=?"
+                    " ORDER BY archive,name",(dhash,)):
+                f.write("#   {0}: {1}\n".format(archive,name))
+
+def pagehashfile(hashfile):
+    # Set of page hashes (sha256 or dHash hex) from the first word of each
+    # line of hashfile, # lines are comments
+    hashes=set()
+    with open(hashfile,"r") as f:
+        for line in f:
+            words=line.split()
+            if not words or words[0].startswith("#"):
+                continue
+            value=words[0].lower()
+            if len(value) not in (16,64) or not re.fullmatch(
+                    r'[0-9a-f]+',value):
+                raise ValueError("Not a page hash: {0}".format(words[0]))
+            hashes.add(value)
+    return(hashes)
+
+# Pipeline stage limits (--pipeline). Conversions running at once wait for
+# a slot of each stage (extract, shrink, zip) in turn, so one archive can be
+# extracted while others are shrunk and zipped without all of them hitting
+# the disk or the CPUs together. Stages without a limit don't wait. The
+# semaphores are multiprocessing ones, shared by the --jobs workers
+stagenames = ["extract","shrink","zip"]
+stagelimits = {}
+
+@contextlib.contextmanager
+def stageslot(stage,stats=None):
+    slot=stagelimits.get(stage)
+    if slot is None:
+        yield
+        return
+    start=time.perf_counter()
+    slot.acquire()
+    statsadd(stats,"stage_wait_seconds",time.perf_counter()-start)
+    try:
+        yield
+    finally:
+        slot.release()
+
+# Process pool (--jobs) helpers. Worker processes don't share the parent's
+# globals on every platform, so they are set up again here. The conversion
+# arguments (with the page rules) are sent once per worker, not per archive
+workerconvertargs = None
+
+def cbr2cbzworkerinit(
+        temproots,imv,imb,exprefs,convertargs,budgetlimit,budgetused
+        ,stages=None):
+    # Workers use the parent's temp roots (workspace folders are named for
+    # the worker) so that main() cleans them all up in one go at the end.
+    # The in-memory budget is counted in budgetused, and the pipeline stage
+    # slots in stages, shared by all the workers
+    global cbr2cbztemp, cbr2cbztemproots, imversion, imbackend
+    global extractorprefs, workerconvertargs, memorybudget, stagelimits
+    cbr2cbztemproots=temproots
+    cbr2cbztemp=temproots[0]
+    imversion=imv
+    imbackend=imb
+    extractorprefs=exprefs
+    workerconvertargs=convertargs
+    memorybudget=MemoryBudget(budgetlimit,budgetused)
+    stagelimits=stages or {}
+
+def cbr2cbzworker(infile,outfile,convertargs=None):
+    # Runs one conversion (in a worker or not), returns
+    # (infile,outfile,result,stats). convertargs defaults to the ones
+    # given to cbr2cbzworkerinit()
+    if convertargs is None:
+        convertargs=workerconvertargs
+    stats={}
+    start=time.perf_counter()
+    result=cbr2cbz(infile,outfile,stats=stats,**convertargs)
+    stats["seconds"]=time.perf_counter()-start
+    return (infile,outfile,result,stats)
 
 def main():
     if (sys.version_info[0]<3):
@@ -529,6 +3246,13 @@ in CatConv
     parser.add_argument(
         "--noconvert",default=False,action="store_true"
         , help="copy CBR/CBZ instead of converting (implies -c)")
+    parser.add_argument(
+        "--link-mode",default="auto",choices=sorted(linkmodes)
+        ,dest="linkmode"
+        ,help="how copies are made: reflink or copy, falling back to"
+        " copying (default = auto, reflink then copy). hardlink makes the"
+        " destination the same file as the source, so editing either"
+        " changes both")
     parser.add_argument(
         "-z","--zipforce",default=False,action="store_true", dest="zipforce"
         ,help="re-zip CBZ archives (remove wasteful compression)")
@@ -541,6 +3265,11 @@ in CatConv
     parser.add_argument(
         "--shrinkGray",default=False,action="store_true"
         ,help="with --shrink convert all pages to grayscale")
+    parser.add_argument(
+        "--shrinkAutoGray",default=False,action="store_true"
+        ,help="with --shrink convert pages that are effectively grayscale"
+        " (eg. black and white scans stored as colour) to grayscale, whatever"
+        " their size (requires Pillow)")
     parser.add_argument(
         "--shrinkKB",default=300, type=int,action="store"
         ,help="with --shrink process pages larger than this many KB (default = 300)")
@@ -550,6 +3279,42 @@ in CatConv
     parser.add_argument(
         "--shrinkHeight",default=1500, type=int,action="store"
         ,help="with --shrink sets maximum pixel height of page (default = 1500)")
+    parser.add_argument(
+        "--target-size",default=0, type=int,action="store", dest="targetKB"
+        ,metavar="KB"
+        ,help="[ WARNING - LOSSY ] shrink to at most this many KB (per"
+        " --target-per) at the highest JPEG quality that fits (implies"
+        " --shrink, replaces --shrinkKB and --shrinkQual)")
+    parser.add_argument(
+        "--target-per",default="archive",choices=["archive","page"]
+        ,dest="targetper"
+        ,help="with --target-size budget the size of each archive or of each"
+        " page (default = archive)")
+    parser.add_argument(
+        "--shrink-format",default="jpeg",choices=sorted(shrinkformats)
+        ,dest="shrinkformat"
+        ,help="with --shrink write pages in this format, if the image"
+        " backend supports it (default = jpeg)")
+    parser.add_argument(
+        "--optimize",default=False,action="store_true"
+        ,help="losslessly optimise pages (JPEG with jpegtran if installed,"
+        " PNG re-deflated), keeping each only if smaller. Page metadata is"
+        " dropped, pixels are unchanged")
+    parser.add_argument(
+        "--shrinkJobs",default=0, type=int,action="store"
+        ,help="with --shrink shrink up to this many pages of an archive in parallel (default = 0, CPU count divided by --jobs)")
+    parser.add_argument(
+        "--pagecache",default=False,action="store"
+        ,help="with --shrink reuse shrunk pages cached in this directory")
+    parser.add_argument(
+        "--pagecacheMB",default=1000, type=int,action="store"
+        ,help="with --pagecache remove least recently used pages above this many MB (default = 1000)")
+    parser.add_argument(
+        "--inmemoryMB",default=64, type=int,action="store"
+        ,help="convert archives up to this many MB uncompressed in memory rather than in the temp folder (default = 64, 0 = never)")
+    parser.add_argument(
+        "--inmemoryBudgetMB",default=512, type=int,action="store"
+        ,help="MB all archives converted in memory at once may use (default = 512)")
     parser.add_argument(
         "-f","--flat",default=False,action="store_true", dest="flat"
         ,help="Flat mode - do not create output subdirectories")
@@ -589,9 +3354,81 @@ in CatConv
     parser.add_argument(
         "--imversion",default=False,type=int,action="store"
         , help="set ImageMagick version command format (default = 6)")
+    parser.add_argument(
+        "--imbackend",default="auto",action="store"
+        ,choices=["auto"]+sorted(imagebackends)
+        , help="image backend for --shrink (default = auto, Pillow if installed)")
+    parser.add_argument(
+        "--extractor",default=[],action="append"
+        , help="set extractor preference for an archive format, eg. rar=7z,unrar (formats: "
+        +", ".join(sorted(extractorprefs))+" extractors: "+", ".join(sorted(extractors))+")")
     parser.add_argument(
         "--tempdir",default=False,action="store"
-        , help="use TEMPDIR as temporary file directory")
+        , help="use TEMPDIR as preferred temporary file directory"
+        " (archives too big for its free space go to the next of"
+        " /run/user/<uid>, /tmp and ~)")
+    parser.add_argument(
+        "-j","--jobs",default=1,type=int,action="store", dest="jobs"
+        , help="convert up to JOBS archives in parallel (default = 1)")
+    parser.add_argument(
+        "--pipeline",default=False,action="store_true"
+        , help="overlap the extract, shrink and zip stages of successive"
+        " archives, with at most --pipelineExtract/Shrink/Zip archives in each"
+        " stage at once (raises --jobs to their total)")
+    parser.add_argument(
+        "--pipelineExtract",default=1,type=int,action="store"
+        , help="with --pipeline archives extracted at once (default = 1)")
+    parser.add_argument(
+        "--pipelineShrink",default=1,type=int,action="store"
+        , help="with --pipeline archives excluded/shrunk/optimised at once"
+        " (default = 1)")
+    parser.add_argument(
+        "--pipelineZip",default=1,type=int,action="store"
+        , help="with --pipeline archives zipped at once, streamed"
+        " conversions included (default = 1)")
+    parser.add_argument(
+        "--scanJobs",default=4,type=int,action="store"
+        , help="scan up to this many top level source folders in parallel (default = 4)")
+    parser.add_argument(
+        "--stats-file",default=False,action="store", dest="statsfile"
+        , help="append a line of JSON statistics per converted archive to this file")
+    parser.add_argument(
+        "--incremental",default=False,action="store_true"
+        , help="keep an index of converted/copied sources in the destination and skip unchanged ones")
+    parser.add_argument(
+        "--rebuild-changed",default=False,action="store_true", dest="rebuildchanged"
+        , help="redo outputs of sources (or options) changed since indexed (implies --incremental)")
+    parser.add_argument(
+        "--indexhash",default=False,action="store_true"
+        , help="with --incremental also index source content hashes so touched but unmodified sources are not redone")
+    parser.add_argument(
+        "--indexfile",default=False,action="store"
+        , help="index file for --incremental (default = DEST/"+indexname+")")
+    parser.add_argument(
+        "--pageindex",default=False,action="store"
+        ,help="record the pages of converted archives by content hash in"
+        " this index file, for --pagereport")
+    parser.add_argument(
+        "--pagescan",default=False,action="store_true"
+        ,help="with --pageindex only hash the pages of the source archives,"
+        " nothing is converted or copied")
+    parser.add_argument(
+        "--pagedhash",default=False,action="store_true"
+        ,help="with --pageindex also record a perceptual hash (dHash) of each"
+        " page, to find copies that were rescaled or recompressed (requires"
+        " Pillow)")
+    parser.add_argument(
+        "--pagereport",default=False,action="store"
+        ,help="with --pageindex write the pages found in several archives to"
+        " this file (usable as an --excludepagehash file)")
+    parser.add_argument(
+        "--pagereportMin",default=2,type=int,action="store"
+        ,help="with --pagereport list pages found in at least this many"
+        " archives (default = 2)")
+    parser.add_argument(
+        "--excludepagehash",default=False,action="store"
+        ,help="exclude pages whose content hash (sha256 or dHash, first word"
+        " of each line) is in this file")
     parser.add_argument('source',default=False,help="source file or directory")
     parser.add_argument('dest',default=False, help="destination directory")
     options = parser.parse_args()
@@ -615,84 +3452,84 @@ in CatConv
 
     if options.noconvert:
         options.copy=True
+    if options.targetKB>0:
+        options.shrink=True
 
-    # Construct lists of RE matches for match, exclude, excludepage
-    if options.cs:
-        reflags= 0
-    else:
-        reflags= re.I
-
-    matchlist=[]
-    if options.matchfile:
-        try:
-            f=os.path.abspath(os.path.expanduser(options.matchfile))
-            text_file = open(f, "r")
-            matchlist = matchlist + [
-                re.compile(x.rstrip(),reflags) for x in text_file.readlines()
-                ]
-            text_file.close()
-        except:
-            exit("Error loading match page file")
-    if options.match:
-        matchlist = matchlist + [
-            re.compile(x.rstrip(),reflags) for x in options.match
-            ]
-
-    excludelist=[]
-    if options.excludefile:
-        try:
-            f=os.path.abspath(os.path.expanduser(options.excludefile))
-            text_file = open(f, "r")
-            excludelist = (
-                excludelist
-                + [re.compile(x.rstrip(),reflags) for x in text_file.readlines()]
-            )
-            text_file.close()
-        except:
-            exit("Error loading exclude page file")
-    if options.exclude:
-        excludelist = (
-            excludelist
-            + [re.compile(x.rstrip(),reflags) for x in options.exclude]
-        )
-    matchpagelist=[]
-    if options.matchpagefile:
-        try:
-            f=os.path.abspath(os.path.expanduser(options.matchpagefile))
-            text_file = open(f, "r")
-            matchpagelist = (
-                matchpagelist
-                + [re.compile(x.rstrip(),reflags) for x in text_file.readlines()]
-            )
-            text_file.close()
-        except:
-            exit("Error loading match page file")
-    if options.matchpage:
-        matchpagelist = matchpagelist + [
-            re.compile(x.rstrip(),reflags) for x in options.matchpage
-            ]
-
-    excludepagelist=[]
-    if options.excludepagefile:
+    # Construct the rule sets for match, exclude, matchpage, excludepage
+    def patternoptions(patternfile,patterns,error):
+        # Rules from patternfile (one per line) followed by those given
+        # on the command line, as a PatternSet
         try:
-            f=os.path.abspath(os.path.expanduser(options.excludepagefile))
-            text_file = open(f, "r")
-            excludepagelist = excludepagelist + [
-                re.compile(x.rstrip(),reflags) for x in text_file.readlines()
-                ]
-            text_file.close()
+            rules=[]
+            if patternfile:
+                f=os.path.abspath(os.path.expanduser(patternfile))
+                text_file = open(f, "r")
+                rules = text_file.readlines()
+                text_file.close()
+            return(PatternSet(rules+patterns,options.cs))
         except:
-            exit("Error loading exclude page file")
-
-    if options.excludepage:
-        excludepagelist = excludepagelist + [
-            re.compile(x.rstrip(),reflags) for x in options.excludepage
-            ]
+            exit(error)
+
+    matchlist=patternoptions(
+        options.matchfile,options.match,"Error loading match page file")
+    excludelist=patternoptions(
+        options.excludefile,options.exclude,"Error loading exclude page file")
+    matchpagelist=patternoptions(
+        options.matchpagefile,options.matchpage
+        ,"Error loading match page file")
+    excludepagelist=patternoptions(
+        options.excludepagefile,options.excludepage
+        ,"Error loading exclude page file")
     
     if options.imversion:
         global imversion
         imversion = options.imversion
 
+    # Extractor preferences for this run, the defaults are left as they are
+    # for later main() or Converter calls in the same process
+    exprefs=dict(extractorprefs)
+    for extractorpref in options.extractor:
+        (fmt,sep,names)=extractorpref.partition("=")
+        names=[x.strip() for x in names.split(",") if x.strip()]
+        if fmt not in exprefs or not names:
+            exit("Error: --extractor {0} should be FORMAT=EXTRACTOR[,EXTRACTOR...]"
+                .format(extractorpref))
+        for name in names:
+            if name not in extractors:
+                exit("Error: --extractor unknown extractor {0}".format(name))
+        exprefs[fmt]=names
+    if options.verbose>1:
+        for fmt in sorted(exprefs):
+            print("** Extractors for {0}: {1} (installed: {2})".format(
+                fmt,exprefs[fmt],extractorlist(fmt,exprefs)))
+
+    if options.imbackend=="pillow" and Image is None:
+        exit("Error: --imbackend pillow requires the Pillow module")
+    if options.shrinkAutoGray and Image is None:
+        exit("Error: --shrinkAutoGray requires the Pillow module")
+    if min(options.pipelineExtract,options.pipelineShrink
+            ,options.pipelineZip)<1:
+        exit("Error: --pipelineExtract/Shrink/Zip must be 1 or more")
+    if (options.pagescan or options.pagereport) and not options.pageindex:
+        exit("Error: --pagescan and --pagereport need --pageindex")
+    if options.pagedhash and Image is None:
+        exit("Error: --pagedhash requires the Pillow module")
+    excludehashes=set()
+    if options.excludepagehash:
+        try:
+            excludehashes=pagehashfile(
+                os.path.abspath(os.path.expanduser(options.excludepagehash)))
+        except (OSError,ValueError) as e:
+            exit("Error loading exclude page hash file: {0}".format(e))
+    global imbackend
+    imbackend = options.imbackend
+    if options.shrink and options.verbose>1:
+        print("** Image backend: {0}".format(imagebackend()))
+    if options.shrink and options.shrinkformat not in imagebackends[
+            imagebackend()]["formats"]():
+        exit("Error: --shrink-format {0} is not supported by image backend {1}"
+            .format(options.shrinkformat,imagebackend()))
+
     # List of candidate directories to put tempdir in, in order of preference
     tempcandidates = [
         "/run/user/{0}/".format(os.getuid()),
@@ -704,15 +3541,21 @@ in CatConv
     if options.tempdir:
         tempcandidates.insert(0, os.path.abspath(os.path.expanduser(options.tempdir)))
 
-    # Find the first existing tempdir host and set cbr2cbztemp
-    global cbr2cbztemp
+    # Every existing tempdir host gets a temp root, the first one is
+    # cbr2cbztemp. Each archive goes to the first with room for it
+    global cbr2cbztemp, cbr2cbztemproots, stagelimits
+    temproots=[]
     for tempc in tempcandidates:
         if os.path.isdir(os.path.abspath( os.path.expanduser(tempc))):
-            cbr2cbztemp="{0}/cbr2cbz.u{1}-p{2}".format(os.path.abspath( os.path.expanduser(tempc)),os.getuid(),os.getpid())
-            print("Using temporary directory: {0}".format(cbr2cbztemp))
-            break
+            temproot="{0}/cbr2cbz.u{1}-p{2}".format(os.path.abspath( os.path.expanduser(tempc)),os.getuid(),os.getpid())
+            if temproot not in temproots:
+                temproots.append(temproot)
+                print("Using temporary directory: {0}".format(temproot))
         else:
             print("tempdir candidate doesn't exists: {0}".format(tempc))
+    if temproots:
+        cbr2cbztemp=temproots[0]
+        cbr2cbztemproots=temproots
 
 
     if options.verbose>3:
@@ -751,6 +3594,26 @@ in CatConv
 
     rescount={x:0 for x in ["copy","convert","excluded","failed","skipped"]}
 
+    if options.rebuildchanged:
+        options.incremental=True
+    index=None
+    if options.incremental:
+        if options.indexfile:
+            indexfile=os.path.abspath(os.path.expanduser(options.indexfile))
+        else:
+            indexfile=os.path.join(dest,indexname)
+        if options.verbose>1:
+            print("** Index: {0}".format(indexfile))
+        if not os.path.isdir(os.path.dirname(indexfile)):
+            if options.whatif:
+                print("WHATIF: Create directory {0}".format(
+                    os.path.dirname(indexfile)))
+            else:
+                os.makedirs(os.path.dirname(indexfile))
+        if os.path.isdir(os.path.dirname(indexfile)):
+            index=indexopen(indexfile)
+        rescount["rebuilt"]=0
+
     if options.verbose>1:
         print ("** Process source directory : "+source)
 
@@ -759,17 +3622,220 @@ in CatConv
     # recurse with os.walk()
     failedlist=[]
 
-    for root,dirs,files in os.walk(source):
+    # --pipeline runs enough archives at once to fill every stage's slots.
+    # Only the shrink stage's archives share the CPUs then
+    shrinkarchives=options.jobs
+    stagelimits={} # Not left over from an earlier main() call
+    if options.pipeline:
+        slots=dict(zip(stagenames,(options.pipelineExtract
+            ,options.pipelineShrink,options.pipelineZip)))
+        options.jobs=max(options.jobs,sum(slots.values()))
+        shrinkarchives=min(options.jobs,options.pipelineShrink)
+        stagelimits={stage: multiprocessing.BoundedSemaphore(n)
+            for (stage,n) in slots.items()}
+        if options.verbose>1:
+            print("** Pipeline: {0} jobs, stage slots {1}".format(
+                options.jobs,slots))
 
-        # A bit kludgey, but restrict dirs and files to the single file for SFM
-        if singlefile:
-            del dirs[:]
-            files=[singlefile]
+    # Share the CPUs between archive (--jobs) and page (--shrinkJobs) workers
+    shrinkjobs=options.shrinkJobs
+    if shrinkjobs<1:
+        shrinkjobs=max(1,(os.cpu_count() or 1)//max(1,shrinkarchives))
 
-        dirs.sort()
-        files.sort()
+    pagecache=None
+    if options.pagecache and options.shrink:
+        pagecache=os.path.abspath(os.path.expanduser(options.pagecache))
+        if options.verbose>1:
+            print("** Page cache: {0}".format(pagecache))
+
+    convertargs=dict(
+        verbose=options.verbose
+        ,exprefs=exprefs
+        ,keepbroken=options.keepbroken
+        ,matchpagelist=matchpagelist
+        ,excludepagelist=excludepagelist
+        ,shrink=options.shrink
+        ,shrinkGray=options.shrinkGray
+        ,shrinkKB=options.shrinkKB
+        ,shrinkQual=options.shrinkQual
+        ,shrinkHeight=options.shrinkHeight
+        ,whatif=options.whatif
+        ,shrinkjobs=shrinkjobs
+        ,pagecache=pagecache
+        ,inmemory=options.inmemoryMB*1000000
+        ,target=options.targetKB*1000
+        ,targetper=options.targetper
+        ,shrinkformat=options.shrinkformat
+        # JPEG reference encodes are only worth it for --stats-file
+        ,shrinkcompare=bool(options.statsfile)
+        ,optimize=options.optimize
+        ,shrinkAutoGray=options.shrinkAutoGray
+        ,hashpages=bool(options.pageindex)
+        # dHashes are needed to exclude by them too
+        ,dhash=options.pagedhash or any(len(x)==16 for x in excludehashes)
+        ,excludehashes=excludehashes
+        ,scanonly=options.pagescan
+        )
+    memorybudget.limit=options.inmemoryBudgetMB*1000000
+
+    # Everything that changes how an archive is converted, as recorded in
+    # the index. Copies don't depend on any option
+    shrinkoptions=options.shrink and dict(
+        backend=imagebackend()
+        ,shrinkGray=options.shrinkGray
+        ,shrinkKB=options.shrinkKB
+        ,shrinkQual=options.shrinkQual
+        ,shrinkHeight=options.shrinkHeight
+        )
+    if shrinkoptions and options.targetKB>0:
+        # Only recorded when set so older index entries still match
+        shrinkoptions["target"]=[options.targetKB,options.targetper]
+    if shrinkoptions and options.shrinkformat!="jpeg":
+        shrinkoptions["format"]=options.shrinkformat
+    if shrinkoptions and options.shrinkAutoGray:
+        shrinkoptions["shrinkAutoGray"]=True
+    optionsextra={}
+    if options.optimize:
+        optionsextra["optimize"]=True
+    if excludehashes:
+        optionsextra["excludepagehash"]=sorted(excludehashes)
+    convertoptions=json.dumps(dict(
+        keepbroken=options.keepbroken
+        ,cs=options.cs
+        ,matchpage=matchpagelist.patterns
+        ,excludepage=excludepagelist.patterns
+        ,shrink=shrinkoptions
+        ,**optionsextra
+        ),sort_keys=True)
+    copyoptions="copy"
+
+    indexuncommitted=0
+    def indexdone(infile,outfile,optionset,st=None):
+        # Record a finished source in the index, committing every so often
+        # so an interrupted run keeps most of its progress
+        nonlocal indexuncommitted
+        if index is None or options.whatif:
+            return
+        if st is None:
+            st=os.stat(infile)
+        indexrecord(index,infile,st,optionset,outfile,options.indexhash)
+        indexuncommitted+=1
+        if indexuncommitted>=100:
+            index.commit()
+            indexuncommitted=0
+
+    pageindex=None
+    pageindexuncommitted=0
+    if options.pageindex and not options.whatif:
+        pageindex=pageindexopen(
+            os.path.abspath(os.path.expanduser(options.pageindex)))
+        if options.pagescan:
+            rescount["scanned"]=0
+
+    statsfile=None
+    if options.statsfile and not options.whatif:
+        statsfile=open(os.path.abspath(os.path.expanduser(options.statsfile))
+            ,"a",buffering=1)
+
+    def convertresult(infile,outfile,result,stats):
+        # Count and report the result of one cbr2cbz() call
+        nonlocal pageindexuncommitted
+        if pageindex is not None and "page_hashes" in stats:
+            pageindexrecord(pageindex,infile,stats.pop("page_hashes"))
+            pageindexuncommitted+=1
+            if pageindexuncommitted>=100:
+                pageindex.commit()
+                pageindexuncommitted=0
+        if options.pagescan:
+            if result:
+                rescount['scanned'] += 1
+                if options.verbose>0:
+                    print("* ResultScanned: {0}".format(infile))
+            else:
+                rescount['failed'] += 1
+                failedlist.append(infile)
+            return
+        if statsfile:
+            statsline={"infile":infile,"outfile":outfile,"result":result}
+            statsline.update(stats)
+            for key in statsline:
+                if key.endswith("seconds"):
+                    statsline[key]=round(statsline[key],4)
+            statsfile.write(json.dumps(statsline,sort_keys=True)+"\n")
+        if result:
+            # cbr2cbz() returned true - SUCCESS!
+            rescount['convert'] += 1
+            destadd(outfile)
+            indexdone(infile,outfile,convertoptions)
+            if pagecache and rescount['convert']%500==0:
+                pagecacheprune(pagecache,options.pagecacheMB*1000000
+                    ,options.verbose)
+            if options.verbose>0:
+                oldsize=os.stat(infile).st_size
+                newsize=os.stat(outfile).st_size
+                print(
+                    "* ResultConvert: {0} {1}/{2} MB {3}"
+                    .format(
+                        round(newsize/oldsize,3)
+                        ,round(newsize/1000000,1)
+                        ,round(oldsize/1000000,1)
+                        ,infile
+                        )
+                    )
+        else:
+            rescount['failed'] += 1
+            if options.verbose>0:
+                print("* ResultFailed: {0}".format(infile))
+            failedlist.append(infile)
+
+    # With --jobs conversions are handed to a process pool. Each worker
+    # has its own temp folder and results are merged back here
+    pool=None
+    pending=set()
+    pendingout=set() # Output files not written yet (matters in flat mode)
+    if options.jobs>1 and not options.whatif:
+        pool=concurrent.futures.ProcessPoolExecutor(
+            max_workers=options.jobs
+            ,initializer=cbr2cbzworkerinit
+            ,initargs=(cbr2cbztemproots,imversion,imbackend,exprefs
+                ,convertargs,memorybudget.limit,multiprocessing.Value('q',0)
+                ,stagelimits)
+            )
 
-        if re.match(re.escape(dest),root):
+    def collectresults(wait=False):
+        # Merge finished worker results. With wait, block until no more
+        # than 2 conversions per worker are queued
+        nonlocal pending
+        while pending:
+            if wait and len(pending)<options.jobs*2:
+                return
+            done,pending=concurrent.futures.wait(
+                pending,return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (infile,outfile,result,stats)=future.result()
+                pendingout.discard(outfile)
+                convertresult(infile,outfile,result,stats)
+
+    # Destination folder listings, existence checks are set lookups
+    listings={}
+    def destadd(outfile):
+        # Note a file written to the destination
+        names=destlisting(listings,os.path.dirname(outfile))
+        if names is not None:
+            names.add(os.path.basename(outfile))
+
+    def insidedest(root):
+        return(re.match(re.escape(dest),root))
+
+    if singlefile:
+        # Just the one file, no subfolders
+        scan=[(source,[],[x for x in scandirectory(source)[1]
+            if x.name==singlefile])]
+    else:
+        scan=scansource(source,options.scanJobs,insidedest)
+    for root,dirs,files in scan:
+
+        if insidedest(root):
             # Current source dir is under the destination - this could be BAD
             if options.verbose>1:
                 print("** Skipping dir - inside destination: {0}".format(root))
@@ -789,7 +3855,8 @@ in CatConv
         else:
             continue
 
-        for leaf in files:
+        for entry in files:
+            leaf=entry.name
             infile= os.path.join(root,leaf)
 
             if options.verbose>2:
@@ -797,19 +3864,13 @@ in CatConv
 
             # Check for match/exclude setting matchflag
             if matchlist :
-                matchflag=False
-                for m in matchlist:
-                    if re.search(m,infile)!=None:
-                        matchflag=True
-                        break
+                matchflag=matchlist.search(infile)
             else:
                 matchflag=True
 
             if excludelist and matchflag:
-                for m in excludelist:
-                    if re.search(m,infile)!=None:
-                        matchflag=False
-                        break
+                if excludelist.search(infile):
+                    matchflag=False
 
             if options.verbose > 4:
                 print("***** Matchflag: {0}".format(matchflag))
@@ -821,6 +3882,19 @@ in CatConv
                 rescount["excluded"] += 1
                 continue
 
+            if options.pagescan:
+                # Only archives, hashed where they are (--pagescan)
+                if not re.search(r'\.[Cc][bB][rRzZ]$',leaf):
+                    continue
+                if options.whatif:
+                    print("WHATIF: Scan pages of {0}".format(infile))
+                elif pool:
+                    pending.add(pool.submit(cbr2cbzworker,infile,infile))
+                    collectresults(wait=True)
+                else:
+                    convertresult(*cbr2cbzworker(infile,infile,convertargs))
+                continue
+
             if options.noconvert:
                 convertflag=False
             else:
@@ -831,25 +3905,59 @@ in CatConv
             if not(convertflag or options.copy):
                 continue
 
-            if not os.path.isdir(outdir):
-                if options.whatif:
-                    print("WHATIF: Create directory {0}".format(outdir))
-                else:
-                    if options.verbose>2:
-                        print ("**   Creating directory {0}".format(outdir))
-                    os.makedirs(outdir)
-
             outfile=os.path.join(outdir,leaf)
             outfile=outfile.replace(u'\xa0', ' ')
             outfile=outfile.encode('ascii', 'replace').decode('ascii', 'replace')
             if convertflag:
                 outfile=re.sub(r'\.[Cc][bB][rR]$','.cbz',outfile)
+                optionset=convertoptions
+            else:
+                optionset=copyoptions
+
+            # With --incremental the index decides without looking at the
+            # destination, unless the source is new to the index
+            indexok=None
+            if index is not None and outfile not in pendingout:
+                indexok=indexcompare(index,infile,entry.stat(),optionset
+                    ,outfile,options.indexhash)
+                if indexok:
+                    rescount["skipped"] += 1
+                    if options.verbose>0:
+                        print("* ResultSkipped (unchanged): {0}".format(infile))
+                    continue
+                if indexok is False and options.verbose>0:
+                    print("* Changed since indexed: {0}".format(infile))
+
+            outnames=destlisting(listings,outdir)
+            if (outnames is not None and os.path.basename(outfile) in outnames
+                    ) or outfile in pendingout:
+                if indexok is False and options.rebuildchanged:
+                    if options.whatif:
+                        print("WHATIF: Remove {0}".format(outfile))
+                    else:
+                        if options.verbose>0:
+                            print("* Rebuilding {0}".format(outfile))
+                        os.remove(outfile)
+                        outnames.discard(os.path.basename(outfile))
+                    rescount["rebuilt"] += 1
+                else:
+                    rescount["skipped"] += 1
+                    if options.verbose>0:
+                        print("* ResultSkipped: {0}".format(infile))
+                    if indexok is None:
+                        # Made by an earlier run without an index. Adopt it
+                        # so the next run can skip it without looking
+                        indexdone(infile,outfile,None,entry.stat())
+                    continue
 
-            if os.path.exists(outfile):
-                rescount["skipped"] += 1
-                if options.verbose>0:
-                    print("* ResultSkipped: {0}".format(infile))
-                continue
+            if outnames is None:
+                if options.whatif:
+                    print("WHATIF: Create directory {0}".format(outdir))
+                else:
+                    if options.verbose>2:
+                        print ("**   Creating directory {0}".format(outdir))
+                    os.makedirs(outdir)
+                    listings[outdir]=set()
 
             if convertflag:
                 if options.whatif:
@@ -857,38 +3965,14 @@ in CatConv
                 else:
                     if options.verbose>0:
                         print ("* Converting {0}".format(infile))
-                    if(cbr2cbz(
-                            infile,outfile,verbose=options.verbose
-                            ,keepbroken=options.keepbroken
-                            ,matchpagelist=matchpagelist
-                            ,excludepagelist=excludepagelist
-                            ,shrink=options.shrink
-                            ,shrinkGray=options.shrinkGray
-                            ,shrinkKB=options.shrinkKB
-                            ,shrinkQual=options.shrinkQual
-                            ,shrinkHeight=options.shrinkHeight
-                            ,whatif=options.whatif
-                            )
-                        ):
-                        # cbr2cbz() returned true - SUCCESS!
-                        rescount['convert'] += 1
-                        if options.verbose>0:
-                            oldsize=os.stat(infile).st_size
-                            newsize=os.stat(outfile).st_size
-                            print(
-                                "* ResultConvert: {0} {1}/{2} MB {3}"
-                                .format(
-                                    round(newsize/oldsize,3)
-                                    ,round(newsize/1000000,1)
-                                    ,round(oldsize/1000000,1)
-                                    ,infile
-                                    )
-                                )
+                    if pool:
+                        pending.add(pool.submit(
+                            cbr2cbzworker,infile,outfile))
+                        pendingout.add(outfile)
+                        collectresults(wait=True)
                     else:
-                        rescount['failed'] += 1
-                        if options.verbose>0:
-                            print("* ResultFailed: {0}".format(infile))
-                        failedlist.append(infile)
+                        convertresult(
+                            *cbr2cbzworker(infile,outfile,convertargs))
                 continue
 
             # not convertflag so options.copy is set
@@ -899,13 +3983,45 @@ in CatConv
             else:
                 if options.verbose>0:
                     print ("* Copying {0}".format(os.path.join(root,leaf)))
-                shutil.copyfile(os.path.join(root,leaf),os.path.join(outdir,leaf))
+                method=linkcopy(os.path.join(root,leaf)
+                    ,os.path.join(outdir,leaf),options.linkmode
+                    ,options.verbose)
+                destadd(os.path.join(outdir,leaf))
                 rescount['copy'] += 1
+                rescount['copy_'+method]=rescount.get('copy_'+method,0)+1
+                indexdone(infile,outfile,copyoptions,entry.stat())
                 if options.verbose>0:
                     print("* ResultCopied: {0}".format(infile))
 
-    # Clean out the temporary folder
-    cbr2cbzclean(create=False,delete=True)
+    if pool:
+        collectresults()
+        pool.shutdown()
+
+    if index is not None:
+        index.commit()
+        index.close()
+
+    if pageindex is not None:
+        pageindex.commit()
+        if options.pagereport:
+            pageindexreport(pageindex
+                ,os.path.abspath(os.path.expanduser(options.pagereport))
+                ,options.pagereportMin)
+            if options.verbose>0:
+                print("* Page report: {0}".format(options.pagereport))
+        pageindex.close()
+
+    if statsfile:
+        statsfile.close()
+
+    if pagecache and os.path.isdir(pagecache):
+        pagecacheprune(pagecache,options.pagecacheMB*1000000,options.verbose)
+
+    # Clean out the temporary folders (and any worker workspaces in them)
+    # once the background deletes are done
+    tempcleanwait()
+    for temproot in cbr2cbztemproots:
+        cbr2cbzclean(create=False,delete=True,tempdir=temproot)
     if options.verbose>0:
         print("* Results:",rescount)
         for countkey in rescount.keys():
@@ -915,4 +4031,8 @@ in CatConv
         for failedfile in failedlist:
             print(failedfile)
 
-main()
+if __name__ == "__main__":
+    try:
+        main()
+    except WorkspaceError as e:
+        exit("ERROR: {0}".format(e))
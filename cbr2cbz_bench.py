@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+cbr2cbz_bench.py - benchmarks cbr2cbz.py on generated comic archives
+
+Generates a reproducible library of CBZ (and CBR shaped, read through a
+local stub unrar) archives, runs cbr2cbz.py over it (a fresh process per run)
+and reports timings as JSON.
+"""
+
+import os
+import sys
+import io
+import re
+import json
+import time
+import random
+import shlex
+import shutil
+import struct
+import subprocess
+import argparse
+import platform
+import tempfile
+import zipfile
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cbr2cbz
+
+# RAR shaped test archives are the RAR4 magic followed by a byte reversed
+# zip (so zipfile.is_zipfile() doesn't see through them). The stub unrar
+# below understands the commands cbr2cbz.py uses on them
+rarmagic = b"Rar!\x1a\x07\x00"
+
+stubunrar = r'''#!/usr/bin/env python3
+# Stub unrar for cbr2cbz_bench.py archives (RAR magic + reversed zip)
+import sys, os, io, zipfile
+args=sys.argv[1:]
+listfile=None
+for a in list(args):
+    if a.startswith("-n@"):
+        listfile=a[3:]
+    if a.startswith("-") and len(a)>1:
+        args.remove(a)
+(cmd,arc)=args[0],args[1]
+data=open(arc,"rb").read()
+if not data.startswith(RARMAGIC):
+    sys.exit(10)
+z=zipfile.ZipFile(io.BytesIO(data[len(RARMAGIC):][::-1]))
+wanted=None
+if listfile:
+    wanted=set(open(listfile,encoding="utf-8").read().splitlines())
+def selected(zi):
+    return wanted is None or zi.filename in wanted
+if cmd in ("lt","vt"):
+    print("\nUNRAR stub\n\nArchive: {0}\nDetails: RAR 4\n".format(arc))
+    for zi in z.infolist():
+        print("        Name: "+zi.filename.rstrip("/"))
+        print("        Type: "+("Directory" if zi.is_dir() else "File"))
+        if not zi.is_dir():
+            print("        Size: {0}".format(zi.file_size))
+            print("       CRC32: {0:08X}".format(zi.CRC))
+        print("       mtime: {0:04d}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d},000".format(*zi.date_time))
+        print()
+elif cmd=="lb":
+    for zi in z.infolist():
+        print(zi.filename.rstrip("/"))
+elif cmd=="p":
+    for zi in z.infolist():
+        if not zi.is_dir() and selected(zi):
+            sys.stdout.buffer.write(z.read(zi))
+elif cmd=="x":
+    dest=args[2] if len(args)>2 else "."
+    for zi in z.infolist():
+        if selected(zi):
+            z.extract(zi,dest)
+else:
+    sys.exit(7)
+'''.replace("RARMAGIC", repr(rarmagic))
+
+def pngbytes(width,height,pixels):
+    # Minimal RGB PNG writer, pixels is width*height*3 bytes
+    def chunk(ctype,data):
+        return(struct.pack(">I",len(data))+ctype+data
+            +struct.pack(">I",zlib.crc32(ctype+data)))
+    stride=width*3
+    raw=b"".join(
+        b"\x00"+pixels[y*stride:(y+1)*stride] for y in range(height))
+    return(b"\x89PNG\r\n\x1a\n"
+        +chunk(b"IHDR",struct.pack(">IIBBBBB",width,height,8,2,0,0,0))
+        +chunk(b"IDAT",zlib.compress(raw,6))
+        +chunk(b"IEND",b""))
+
+def pagepixels(rng,width,height,block=8):
+    # Blocky random RGB page - compresses roughly like a scanned page
+    bw=(width+block-1)//block
+    rows=[]
+    for by in range((height+block-1)//block):
+        small=rng.randbytes(bw*3)
+        row=b"".join(small[x*3:x*3+3]*block for x in range(bw))[:width*3]
+        rows.append(row*min(block,height-by*block))
+    return(b"".join(rows))
+
+def makepage(rng,width,height,jpeg,quality=90):
+    # Returns (extension, bytes) of one generated page. JPEG pages need
+    # Pillow, without it every page is a PNG
+    pixels=pagepixels(rng,width,height)
+    if jpeg and cbr2cbz.Image is not None:
+        img=cbr2cbz.Image.frombytes("RGB",(width,height),pixels)
+        buf=io.BytesIO()
+        img.save(buf,"JPEG",quality=quality)
+        return("jpg",buf.getvalue())
+    return("png",pngbytes(width,height,pixels))
+
+def makelibrary(libdir,options):
+    # Generate the benchmark library. Returns (archives, bytes)
+    rng=random.Random(options.seed)
+    total=0
+    for a in range(options.archives):
+        buf=io.BytesIO()
+        with zipfile.ZipFile(buf,"w") as z:
+            for p in range(options.pages):
+                (ext,data)=makepage(rng,options.width,options.height
+                    ,rng.random()<options.jpeg)
+                if rng.random()<options.stored:
+                    compress=zipfile.ZIP_STORED
+                else:
+                    compress=zipfile.ZIP_DEFLATED
+                z.writestr("Issue {0:03d}/{1:03d}.{2}".format(a,p,ext),data
+                    ,compress_type=compress)
+            # The sort of extra file --excludepage is used for
+            z.writestr("Issue {0:03d}/Thumbs.db".format(a),rng.randbytes(4096)
+                ,compress_type=zipfile.ZIP_DEFLATED)
+        sub=os.path.join(libdir,"series{0:02d}".format(a%max(1,options.series)))
+        os.makedirs(sub,exist_ok=True)
+        if rng.random()<options.cbr:
+            data=rarmagic+buf.getvalue()[::-1]
+            name="issue{0:03d}.cbr".format(a)
+        else:
+            data=buf.getvalue()
+            name="issue{0:03d}.cbz".format(a)
+        with open(os.path.join(sub,name),"wb") as f:
+            f.write(data)
+        total+=len(data)
+    return(options.archives,total)
+
+def treesize(top):
+    total=0
+    for root,dirs,files in os.walk(top):
+        for leaf in files:
+            total+=os.path.getsize(os.path.join(root,leaf))
+    return(total)
+
+def runmain(libdir,outdir,args,verbose=0):
+    # Run cbr2cbz.py once, returns a result dict. Stage timings and
+    # subprocess counts come from the cbr2cbz.py --stats-file lines. Each
+    # run is its own process so module state set by one scenario (pipeline
+    # slots, extractor preferences ...) can't carry into the next
+    statsfile=outdir+".stats.jsonl"
+    if os.path.exists(statsfile):
+        os.remove(statsfile)
+    subcom=([sys.executable,os.path.abspath(cbr2cbz.__file__)
+        ,"--stats-file",statsfile]+args+[libdir,outdir])
+    start=time.perf_counter()
+    subprocess.run(subcom
+        ,stdout=None if verbose>0 else subprocess.DEVNULL)
+    wall=time.perf_counter()-start
+    stages={}
+    subprocesses=0
+    methods={}
+    if os.path.exists(statsfile):
+        with open(statsfile) as f:
+            for line in f:
+                stats=json.loads(line)
+                for key in stats:
+                    if key.endswith("_seconds"):
+                        stage=key[:-len("_seconds")]
+                        stages[stage]=stages.get(stage,0)+stats[key]
+                subprocesses+=stats.get("subprocesses",0)
+                method=stats.get("method","none")
+                methods[method]=methods.get(method,0)+1
+        os.remove(statsfile)
+    return({"wall":wall,"stages":stages,"subprocesses":subprocesses
+        ,"methods":methods,"bytes_out":treesize(outdir)})
+
+def median(values):
+    values=sorted(values)
+    mid=len(values)//2
+    if len(values)%2:
+        return(values[mid])
+    return((values[mid-1]+values[mid])/2)
+
+def main():
+    parser=argparse.ArgumentParser(
+        description="Benchmark cbr2cbz.py on generated comic archives")
+    parser.add_argument("--archives",default=20,type=int
+        ,help="number of archives to generate (default = 20)")
+    parser.add_argument("--pages",default=24,type=int
+        ,help="pages per archive (default = 24)")
+    parser.add_argument("--width",default=1000,type=int
+        ,help="page width in pixels (default = 1000)")
+    parser.add_argument("--height",default=1500,type=int
+        ,help="page height in pixels (default = 1500)")
+    parser.add_argument("--jpeg",default=0.8,type=float
+        ,help="fraction of JPEG pages, the rest are PNG (default = 0.8)")
+    parser.add_argument("--stored",default=0.5,type=float
+        ,help="fraction of pages stored rather than deflated (default = 0.5)")
+    parser.add_argument("--cbr",default=0.5,type=float
+        ,help="fraction of RAR shaped archives (default = 0.5)")
+    parser.add_argument("--series",default=4,type=int
+        ,help="number of subdirectories to spread archives over (default = 4)")
+    parser.add_argument("--seed",default=1,type=int
+        ,help="random seed for the generated library (default = 1)")
+    parser.add_argument("--repeat",default=3,type=int
+        ,help="runs per scenario, the median is reported (default = 3)")
+    parser.add_argument("--scenario",default=[],action="append"
+        ,help="NAME=ARGS cbr2cbz.py arguments to benchmark, may be repeated "
+        "(default = rezip=-z and, with an image backend, shrink=-z --shrink)")
+    parser.add_argument("--workdir",default=False
+        ,help="generate the library here and keep it (default = temporary)")
+    parser.add_argument("-o","--output",default=False
+        ,help="write the JSON report to this file (default = stdout)")
+    parser.add_argument("-v","--verbose",default=0,action="count"
+        ,help="show cbr2cbz.py output")
+    options=parser.parse_args()
+
+    scenarios=[]
+    for scenario in options.scenario:
+        (name,sep,args)=scenario.partition("=")
+        if not sep:
+            exit("Error: --scenario should be NAME=ARGS")
+        scenarios.append((name,shlex.split(args)))
+    if not scenarios:
+        scenarios.append(("rezip",["-z"]))
+        if cbr2cbz.Image is not None or shutil.which("convert"):
+            scenarios.append(("shrink",["-z","--shrink"]))
+
+    if options.workdir:
+        workdir=os.path.abspath(os.path.expanduser(options.workdir))
+        os.makedirs(workdir,exist_ok=True)
+    else:
+        workdir=tempfile.mkdtemp(prefix="cbr2cbz-bench-")
+    libdir=os.path.join(workdir,"library")
+    bindir=os.path.join(workdir,"bin")
+    try:
+        # Stub unrar first on the PATH (bsdtar/7z can't read the stub
+        # archives and just fall through to it)
+        os.makedirs(bindir,exist_ok=True)
+        with open(os.path.join(bindir,"unrar"),"w") as f:
+            f.write(stubunrar)
+        os.chmod(os.path.join(bindir,"unrar"),0o755)
+        os.environ["PATH"]=bindir+os.pathsep+os.environ.get("PATH","")
+
+        start=time.perf_counter()
+        if os.path.isdir(libdir):
+            archives=sum(
+                len(files) for root,dirs,files in os.walk(libdir))
+            bytesin=treesize(libdir)
+        else:
+            (archives,bytesin)=makelibrary(libdir,options)
+        generate=time.perf_counter()-start
+
+        report={
+            "environment":{
+                "python":platform.python_version()
+                ,"platform":platform.platform()
+                ,"cpus":os.cpu_count()
+                ,"pillow":cbr2cbz.Image.__version__ if cbr2cbz.Image else None
+                }
+            ,"library":{
+                "archives":archives,"pages":options.pages
+                ,"width":options.width,"height":options.height
+                ,"jpeg":options.jpeg,"stored":options.stored
+                ,"cbr":options.cbr,"seed":options.seed
+                ,"bytes":bytesin,"generate_seconds":round(generate,3)
+                }
+            ,"scenarios":{}
+            }
+
+        for (name,args) in scenarios:
+            runs=[]
+            for r in range(options.repeat):
+                outdir=os.path.join(workdir,"out-{0}-{1}".format(
+                    re.sub(r"\W","_",name),r))
+                shutil.rmtree(outdir,ignore_errors=True)
+                runs.append(runmain(libdir,outdir,args,options.verbose))
+                shutil.rmtree(outdir,ignore_errors=True)
+            wall=median([x["wall"] for x in runs])
+            stages={}
+            for stage in sorted(set(y for x in runs for y in x["stages"])):
+                stages[stage]=round(
+                    median([x["stages"].get(stage,0) for x in runs]),4)
+            report["scenarios"][name]={
+                "args":args
+                ,"wall_seconds":round(wall,4)
+                ,"archives_per_second":round(archives/wall,3)
+                ,"mb_in_per_second":round(bytesin/1000000/wall,3)
+                ,"bytes_out":runs[-1]["bytes_out"]
+                ,"subprocesses_per_archive":round(
+                    median([x["subprocesses"] for x in runs])/max(1,archives),3)
+                ,"stage_seconds":stages
+                ,"methods":runs[-1]["methods"]
+                ,"runs":[round(x["wall"],4) for x in runs]
+                }
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+    text=json.dumps(report,indent=2,sort_keys=True)
+    if options.output:
+        with open(options.output,"w") as f:
+            f.write(text+"\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()